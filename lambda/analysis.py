@@ -0,0 +1,102 @@
+import json
+from fnmatch import fnmatchcase
+from typing import Any, Dict, List, Optional, Tuple
+
+IMPOSSIBLE = "impossible"
+POSSIBLE = "possible"
+UNKNOWN = "unknown"
+
+PUBLIC_GRANTEES = (
+    "http://acs.amazonaws.com/groups/global/AllUsers",
+    "http://acs.amazonaws.com/groups/global/AuthenticatedUsers",
+)
+
+
+def _as_list(value: Any) -> List[Any]:
+    return value if isinstance(value, list) else [value]
+
+
+def _combine(*verdicts: str) -> str:
+    if POSSIBLE in verdicts:
+        return POSSIBLE
+    return UNKNOWN if UNKNOWN in verdicts else IMPOSSIBLE
+
+
+def _statement_verdict(statement: Dict[str, Any], action: str) -> str:
+    if statement.get("Effect") != "Allow":
+        return IMPOSSIBLE
+    if "NotPrincipal" in statement or "NotAction" in statement:
+        return UNKNOWN  # Too clever to rule out
+    principal = statement.get("Principal")
+    principals = (
+        _as_list(principal.get("AWS", []))
+        if isinstance(principal, dict)
+        else [principal]
+    )
+    if "*" not in principals or not any(
+        fnmatchcase(action.lower(), pattern.lower())
+        for pattern in _as_list(statement.get("Action", []))
+    ):
+        return IMPOSSIBLE
+    # Conditions (e.g. on source IP) are what other tools get wrong, so let
+    # the probe decide
+    return UNKNOWN if statement.get("Condition") else POSSIBLE
+
+
+def policy_verdict(policy: Optional[str], action: str) -> str:
+    """Whether the bucket policy lets anonymous users perform action."""
+    if not policy:
+        return IMPOSSIBLE
+    try:
+        statements = _as_list(json.loads(policy)["Statement"])
+        return _combine(*(_statement_verdict(s, action) for s in statements))
+    except (ValueError, KeyError, TypeError, AttributeError):
+        return UNKNOWN
+
+
+def acl_verdict(
+    grants: List[Dict[str, Any]], acl_permissions: Optional[Tuple[str, ...]]
+) -> str:
+    """Whether the bucket ACL grants the public any of acl_permissions.
+
+    acl_permissions is None when object ACLs decide, which we don't know.
+    """
+    if acl_permissions is None:
+        return UNKNOWN
+    public = any(
+        grant["Grantee"].get("URI") in PUBLIC_GRANTEES
+        and grant["Permission"] in acl_permissions
+        for grant in grants
+    )
+    return POSSIBLE if public else IMPOSSIBLE
+
+
+def classify(
+    access: Optional[Dict[str, Any]],
+    action: str,
+    acl_permissions: Optional[Tuple[str, ...]],
+) -> str:
+    """Classify whether an anonymous probe for action could succeed.
+
+    access is the bucket's entry in the s3_bucket_access config. IMPOSSIBLE
+    means its public access block, ACLs and policy rule it out, POSSIBLE
+    that they allow it and UNKNOWN that only a probe can tell.
+    """
+    if access is None:
+        return UNKNOWN  # Config from before access was recorded
+    block = access["public_access_block"] or {}
+    acls_apply = not block.get("IgnorePublicAcls") and (
+        access["object_ownership"] != "BucketOwnerEnforced"  # ACLs disabled
+    )
+    return _combine(
+        (
+            acl_verdict(access["public_grants"], acl_permissions)
+            if acls_apply
+            else IMPOSSIBLE
+        ),
+        (
+            IMPOSSIBLE
+            if block.get("RestrictPublicBuckets")
+            else policy_verdict(access["policy"], action)
+        ),
+    )
@@ -0,0 +1,101 @@
+"""Checkpoints of an unfinished run's probe results, so the next invocation
+can resume it, e.g. after a Lambda timeout.
+
+Results are keyed by test, config key and bucket, so a resumed run only
+reuses those which still match its configs.
+"""
+
+import gzip
+import json
+import logging
+import time
+from datetime import datetime, timedelta
+from typing import Any, Dict, List, Optional, Tuple
+
+import clients
+from engine import Inconclusive, ProbeResult
+from json_dumper import dumps
+from s3_bucket_inspector import issue_from_json
+
+log = logging.getLogger(__name__)
+CHECKPOINT_KEY = "checkpoints/latest.json.gz"
+ProbeKey = Tuple[str, str, str]  # Test, config key, bucket
+
+
+class Checkpoint:
+    """Results of the probes a run has finished, saved every `interval` seconds."""
+
+    def __init__(
+        self,
+        output_bucket_name: str,
+        interval: float = 60.0,
+        max_age: timedelta = timedelta(hours=24),
+    ) -> None:
+        self._bucket_name = output_bucket_name
+        self._interval = interval
+        self._max_age = max_age
+        self.start_time: Optional[datetime] = None
+        self._results: Dict[ProbeKey, List[Any]] = {}  # [kind, issue JSON or error]
+        self._saved = time.monotonic()
+
+    def load(self, now: datetime) -> bool:
+        """Load the latest checkpoint, returning whether there was a recent one."""
+        response = clients.get_or_none(
+            clients.s3_client().get_object, Bucket=self._bucket_name, Key=CHECKPOINT_KEY
+        )
+        if not response:
+            return False
+        checkpoint = json.loads(gzip.decompress(response["Body"].read()))
+        start_time = datetime.fromisoformat(checkpoint["start_time"])
+        if now - start_time > self._max_age:
+            log.warning("Not resuming the run started at %s: too old", start_time)
+            return False
+        self.start_time = start_time
+        self._results = {
+            (test, config_key, bucket_name): result
+            for test, config_key, bucket_name, *result in checkpoint["results"]
+        }
+        log.warning(
+            "Resuming the run started at %s with %d probe results",
+            start_time,
+            len(self._results),
+        )
+        return True
+
+    def __contains__(self, key: ProbeKey) -> bool:
+        return key in self._results
+
+    def get(self, key: ProbeKey) -> ProbeResult:
+        kind, value = self._results[key]
+        if kind == "issue":
+            return issue_from_json(value)
+        return Inconclusive(value) if kind == "inconclusive" else None
+
+    def add(self, key: ProbeKey, result: ProbeResult) -> None:
+        """Record a probe's result, saving the checkpoint if it's due."""
+        if isinstance(result, Inconclusive):
+            self._results[key] = ["inconclusive", result.error]
+        elif result:
+            self._results[key] = ["issue", result.to_json(False)]
+        else:
+            self._results[key] = ["none", None]
+        if time.monotonic() - self._saved >= self._interval:
+            self.save()
+
+    def save(self) -> None:
+        checkpoint = {
+            "start_time": self.start_time,
+            "results": [[*key, *result] for key, result in self._results.items()],
+        }
+        clients.s3_client().put_object(
+            Body=gzip.compress(dumps(checkpoint).encode()),
+            Bucket=self._bucket_name,
+            Key=CHECKPOINT_KEY,
+        )
+        self._saved = time.monotonic()
+        log.info("Checkpointed %d probe results", len(self._results))
+
+    def clear(self) -> None:
+        """Forget the checkpoint once the run's output is uploaded."""
+        clients.s3_client().delete_object(Bucket=self._bucket_name, Key=CHECKPOINT_KEY)
+        self._results = {}
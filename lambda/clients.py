@@ -0,0 +1,59 @@
+import threading
+from functools import lru_cache
+from typing import Any, Callable, Dict, Optional
+
+import boto3
+from botocore.client import BaseClient
+from botocore.config import Config
+from botocore.exceptions import ClientError
+
+# Adaptive mode rate limits the client itself when AWS starts throttling,
+# on top of retrying throttled calls with exponential backoff
+CLIENT_CONFIG = Config(
+    retries={"mode": "adaptive", "max_attempts": 10}, max_pool_connections=32
+)
+
+_lock = threading.Lock()  # boto3's default session isn't thread-safe
+
+
+@lru_cache(maxsize=None)
+def _client(service: str, region: Optional[str]) -> BaseClient:
+    return boto3.client(service, region_name=region, config=CLIENT_CONFIG)
+
+
+def client(service: str, region: Optional[str] = None) -> BaseClient:
+    """Authenticated client, shared across threads and invocations."""
+    with _lock:
+        return _client(service, region)
+
+
+def s3_client(region: Optional[str] = None) -> BaseClient:
+    """Authenticated S3 client for region.
+
+    Calls about a bucket should go to a client in the bucket's region, which
+    saves S3 redirecting each of them there.
+    """
+    return client("s3", region)
+
+
+def get_or_none(
+    call: Callable[..., Dict[str, Any]], missing_code: str = "NoSuchKey", **kwargs: Any
+) -> Optional[Dict[str, Any]]:
+    """Make the call, or return None if what it gets is missing, e.g. an S3 object."""
+    try:
+        return call(**kwargs)
+    except ClientError as e:
+        if e.response["Error"]["Code"] == missing_code:
+            return None
+        raise
+
+
+@lru_cache(maxsize=None)
+def account_id() -> str:
+    return str(client("sts").get_caller_identity()["Account"])
+
+
+def clear() -> None:
+    with _lock:
+        _client.cache_clear()
+        account_id.cache_clear()
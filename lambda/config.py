@@ -1,11 +1,23 @@
 import json
 import logging
-from typing import Any, Callable, Dict, List
+from concurrent.futures import as_completed, ThreadPoolExecutor
+from typing import Any, Callable, Dict, Generator, List, Tuple
 
-import boto3
+from botocore.client import BaseClient
 
+import clients
 from json_dumper import dumps
-from s3_bucket_inspector import get_s3_bucket_list, get_s3_random_files
+from metrics import metrics
+from s3_bucket_inspector import (
+    access_settings,
+    account_public_access_block,
+    get_s3_bucket_access,
+    get_s3_bucket_fingerprints,
+    get_s3_bucket_list,
+    get_s3_bucket_regions,
+    get_s3_random_files,
+    lookup_bucket_locations,
+)
 
 log = logging.getLogger(__name__)
 
@@ -16,41 +28,83 @@ class ConfigGenerator:
 
     def upload_config(self, output: Dict[str, Any]) -> None:
         """Upload the config to the config bucket with account ID as the key"""
-        account = boto3.client("sts").get_caller_identity().get("Account")
+        account = clients.account_id()
         output_key = f"{account}.json"
         log.info("Uploading to s3://%s/%s", self._bucket_name, output_key)
-        boto3.client("s3").put_object(
+        clients.s3_client().put_object(
             Body=dumps(output),
             Bucket=self._bucket_name,
             Key=output_key,
             ACL="bucket-owner-read",
         )
 
-    def generate_and_upload(self) -> None:
-        self.upload_config(generate())
+    def generate_and_upload(self, **options: Any) -> None:
+        self.upload_config(generate(**options))
 
 
-def generate() -> Dict[str, Any]:
+def generate(listing_workers: int = 16, **options: Any) -> Dict[str, Any]:
+    """Run each config generator, passing options on to all of them.
+
+    Buckets are listed, located and have their access settings fetched once
+    up front, and the generators share those and a client per region.
+    """
     config_generators: List[Callable[..., Any]] = [
-        get_s3_bucket_list,
+        get_s3_bucket_regions,
         get_s3_random_files,
+        get_s3_bucket_fingerprints,
+        get_s3_bucket_access,
     ]
-    output = {
-        generator.__name__[4:]: generator(s3_client=boto3.client("s3"))
-        for generator in config_generators
-    }
+    s3_client = clients.s3_client()
+    bucket_names = get_s3_bucket_list(s3_client)
+    locations = lookup_bucket_locations(s3_client, bucket_names, listing_workers)
+    settings = access_settings(s3_client, bucket_names, locations, listing_workers)
+    account_block = account_public_access_block()
+    output: Dict[str, Any] = {"s3_bucket_list": bucket_names}
+    for generator in config_generators:
+        output[generator.__name__[4:]] = generator(
+            s3_client=s3_client,
+            bucket_names=bucket_names,
+            bucket_locations=locations,
+            bucket_settings=settings,
+            account_block=account_block,
+            listing_workers=listing_workers,
+            **options,
+        )
     return output
 
 
-def get_configs(config_bucket_name: str) -> Dict[str, Dict[str, Any]]:
+def config_keys(s3: BaseClient, config_bucket_name: str) -> Generator[str, None, None]:
+    for page in s3.get_paginator("list_objects_v2").paginate(Bucket=config_bucket_name):
+        for config_obj in page.get("Contents", []):
+            if config_obj["Key"] != "whitelist.json":
+                yield config_obj["Key"]
+
+
+def iter_configs(
+    config_bucket_name: str, workers: int = 16
+) -> Generator[Tuple[str, Dict[str, Any]], None, None]:
+    """Fetch configs for all accounts, yielding each (key, config) as it arrives."""
+    s3 = clients.s3_client()
+
+    def fetch(key: str) -> Dict[str, Any]:
+        return json.load(s3.get_object(Bucket=config_bucket_name, Key=key)["Body"])
+
+    with metrics.timer("phase.config_fetch"):  # Overlaps probing when streamed
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            futures = {
+                executor.submit(fetch, key): key
+                for key in config_keys(s3, config_bucket_name)
+            }
+            for future in as_completed(futures):
+                yield futures[future], future.result()
+
+
+def get_configs(
+    config_bucket_name: str, workers: int = 16
+) -> Dict[str, Dict[str, Any]]:
     """Fetch configs for all accounts."""
-    s3 = boto3.client("s3")
-    config_keys = [
-        config_obj["Key"]
-        for config_obj in s3.list_objects_v2(Bucket=config_bucket_name)["Contents"]
-        if config_obj["Key"] != "whitelist.json"
-    ]
-    return {
-        key: json.load(s3.get_object(Bucket=config_bucket_name, Key=key)["Body"])
-        for key in config_keys
-    }
+    return dict(sorted(iter_configs(config_bucket_name, workers)))
+
+
+def account_from_key(config_key: str) -> str:
+    return config_key.split(".")[0]  # 123.json -> 123
@@ -0,0 +1,174 @@
+import heapq
+import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from queue import Queue
+from typing import (
+    Any,
+    Callable,
+    Dict,
+    Generator,
+    Iterable,
+    List,
+    NamedTuple,
+    Optional,
+    Tuple,
+    TypeVar,
+    Union,
+)
+from urllib.parse import urlparse
+
+from issues import Issue
+from metrics import metrics
+from probe_client import ProbeError
+from s3_bucket_inspector import bucket_root, BucketTest, Submit
+
+log = logging.getLogger(__name__)
+K = TypeVar("K")  # Key a probe is given with, e.g. its place in the output
+
+
+class Probe(NamedTuple):
+    test: BucketTest
+    bucket_name: str
+
+
+class Inconclusive(NamedTuple):
+    """A probe which couldn't tell either way, e.g. because S3 kept throttling it."""
+
+    error: str
+
+
+class Unprobed(NamedTuple):
+    """A probe which wasn't sent because the run's deadline had passed."""
+
+
+ProbeResult = Union[Issue, Inconclusive, Unprobed, None]
+
+
+class _Slots:
+    """A semaphore from which several slots can be taken at once."""
+
+    def __init__(self, size: int) -> None:
+        self._free = size
+        self._condition = threading.Condition()
+
+    @contextmanager
+    def hold(self, count: int) -> Generator[None, None, None]:
+        with self._condition:
+            self._condition.wait_for(lambda: self._free >= count)
+            self._free -= count
+        try:
+            yield
+        finally:
+            with self._condition:
+                self._free += count
+                self._condition.notify_all()
+
+
+class ProbeEngine:
+    """Runs (test, bucket) probes concurrently with bounded parallelism.
+
+    At most `max_workers` requests are in flight overall and at most
+    `max_per_endpoint` against any single S3 host. A probe holds a slot for
+    each of the requests its test sends at once, which it sends through a
+    pool owned by the run. Results are yielded as probes finish, so callers
+    can record them straight away and sort them by key once the run is done.
+    A probe which fails with ProbeError gives an Inconclusive result rather
+    than failing the run.
+
+    Given a priority, each free worker takes the waiting probe with the lowest
+    priority rather than the first given. Probes which would start after the
+    deadline (a time.monotonic() time) aren't sent and are Unprobed instead.
+    """
+
+    def __init__(
+        self,
+        max_workers: int = 16,
+        max_per_endpoint: int = 4,
+        deadline: Optional[float] = None,
+    ) -> None:
+        self._max_workers = max_workers
+        self._max_per_endpoint = max_per_endpoint
+        self._deadline = deadline
+        self._slots = _Slots(max_workers)
+        self._endpoint_slots: Dict[str, _Slots] = {}
+        self._lock = threading.Lock()
+
+    def run(
+        self,
+        probes: Iterable[Tuple[K, Probe]],
+        priority: Optional[Callable[[Probe], Any]] = None,
+    ) -> Generator[Tuple[K, Probe, ProbeResult], None, None]:
+        """Run the probes, each given with a key, yielding each with its key and
+        result as soon as it finishes, while later probes are still coming."""
+        waiting: List[Tuple[Any, int, K, Probe]] = []  # Heap by priority
+        waiting_lock = threading.Lock()
+        finished: "Queue[Tuple[K, Probe, ProbeResult, Optional[BaseException]]]"
+        finished = Queue()
+
+        def check_next(submit: Submit) -> None:
+            with waiting_lock:
+                _, _, key, probe = heapq.heappop(waiting)
+            if self._deadline is not None and time.monotonic() > self._deadline:
+                metrics.increment("probes.unprobed")
+                finished.put((key, probe, Unprobed(), None))
+                return
+            try:
+                finished.put((key, probe, self._check(probe, submit), None))
+            except BaseException as e:  # pylint: disable=broad-except
+                finished.put((key, probe, None, e))
+
+        def result(block: bool) -> Tuple[K, Probe, ProbeResult]:
+            key, probe, probe_result, error = finished.get(block)
+            if error:
+                raise error
+            return key, probe, probe_result
+
+        with ThreadPoolExecutor(
+            max_workers=self._max_workers
+        ) as executor, ThreadPoolExecutor(
+            max_workers=self._max_workers, thread_name_prefix="requests"
+        ) as requests:
+            scheduled = unfinished = 0
+            for key, probe in probes:
+                with waiting_lock:
+                    heapq.heappush(
+                        waiting,
+                        (priority(probe) if priority else 0, scheduled, key, probe),
+                    )
+                # A worker for whichever probe is next
+                executor.submit(check_next, requests.submit)
+                scheduled += 1
+                unfinished += 1
+                while not finished.empty():  # Only this thread takes results
+                    unfinished -= 1
+                    yield result(block=False)
+            log.info("Scheduled %d probes", scheduled)
+            for _ in range(unfinished):
+                yield result(block=True)
+
+    def _check(self, probe: Probe, submit: Submit) -> ProbeResult:
+        at_once = min(
+            probe.test.requests_at_once, self._max_per_endpoint, self._max_workers
+        )
+        try:
+            with self._endpoint_slots_for(probe.bucket_name).hold(at_once):
+                with self._slots.hold(at_once):
+                    return probe.test.check_with(probe.bucket_name, submit, at_once)
+        except ProbeError as e:
+            test_name = type(probe.test).__name__
+            log.warning("Inconclusive %s of '%s': %s", test_name, probe.bucket_name, e)
+            metrics.increment("inconclusive")
+            return Inconclusive(str(e))
+
+    def _endpoint_slots_for(self, bucket_name: str) -> _Slots:
+        host = endpoint(bucket_name)
+        with self._lock:
+            return self._endpoint_slots.setdefault(host, _Slots(self._max_per_endpoint))
+
+
+def endpoint(bucket_name: str) -> str:
+    """The host anonymous probes against this bucket are sent to."""
+    return urlparse(bucket_root(bucket_name)).netloc
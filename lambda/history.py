@@ -0,0 +1,151 @@
+"""History of issues across runs, partitioned by day in the output bucket.
+
+Each day's partition at history/<day>.json.gz lists every issue seen that
+day with when it was first seen in its current streak and when it was last
+seen. Past partitions are never rewritten; today's is rewritten by each run.
+"""
+
+import gzip
+import json
+import logging
+from datetime import date, datetime, timedelta
+from typing import Any, Dict, List, Optional, Set, Tuple
+
+import clients
+
+log = logging.getLogger(__name__)
+HISTORY_PREFIX = "history/"
+LATEST_KEY = f"{HISTORY_PREFIX}latest.json"  # Day of the newest partition
+Pair = Tuple[str, str]  # Issue, resource
+
+
+class Partition:
+    def __init__(self, day: date, last_run: Optional[datetime] = None) -> None:
+        self.day = day
+        self.last_run = last_run
+        self.entries: Dict[Pair, Tuple[datetime, datetime]] = {}  # Since, last seen
+
+    def is_open(self, pair: Pair) -> bool:
+        """Whether the issue was seen by the partition's last run."""
+        return pair in self.entries and self.entries[pair][1] == self.last_run
+
+    def to_json(self) -> Dict[str, Any]:
+        return {
+            "day": self.day.isoformat(),
+            "last_run": self.last_run and self.last_run.isoformat(),
+            "issues": [  # Columns rather than objects, to keep it compact
+                [issue, resource, since.isoformat(), last_seen.isoformat()]
+                for (issue, resource), (since, last_seen) in sorted(
+                    self.entries.items()
+                )
+            ],
+        }
+
+    @classmethod
+    def from_json(cls, js: Dict[str, Any]) -> "Partition":
+        partition = cls(
+            date.fromisoformat(js["day"]),
+            js["last_run"] and datetime.fromisoformat(js["last_run"]),
+        )
+        for issue, resource, since, last_seen in js["issues"]:
+            partition.entries[(issue, resource)] = (
+                datetime.fromisoformat(since),
+                datetime.fromisoformat(last_seen),
+            )
+        return partition
+
+
+def partition_key(day: date) -> str:
+    return f"{HISTORY_PREFIX}{day.isoformat()}.json.gz"
+
+
+def read_partition(s3: Any, bucket_name: str, day: date) -> Optional[Partition]:
+    response = clients.get_or_none(
+        s3.get_object, Bucket=bucket_name, Key=partition_key(day)
+    )
+    if not response:
+        return None
+    return Partition.from_json(json.loads(gzip.decompress(response["Body"].read())))
+
+
+def latest_partition(s3: Any, bucket_name: str) -> Optional[Partition]:
+    latest = clients.get_or_none(s3.get_object, Bucket=bucket_name, Key=LATEST_KEY)
+    if not latest:
+        return None
+    return read_partition(
+        s3, bucket_name, date.fromisoformat(json.load(latest["Body"])["day"])
+    )
+
+
+def update_history(
+    s3: Any,
+    bucket_name: str,
+    run_time: datetime,
+    issues: Set[Pair],
+    unverified: Set[Pair],
+) -> Optional[Partition]:
+    """Record a run's issues in its day's partition.
+
+    Only today's partition, or failing that the newest one, is read. Issues
+    open at the last run stay open through a run which didn't verify them,
+    e.g. because their probe was inconclusive. History is append-only, so runs older than
+    the newest partition aren't recorded.
+    """
+    previous = latest_partition(s3, bucket_name)
+    if previous and (
+        previous.day > run_time.date()
+        or (previous.last_run and previous.last_run > run_time)
+    ):
+        log.warning("Not recording %s in history, which has later runs", run_time)
+        return None
+    partition = Partition(run_time.date(), run_time)
+    if previous and previous.day == partition.day:
+        partition.entries = dict(previous.entries)  # Keep issues seen earlier today
+    was_open = (
+        {pair for pair in previous.entries if previous.is_open(pair)}
+        if previous
+        else set()
+    )
+    for pair in issues | (was_open & unverified):
+        since = previous.entries[pair][0] if previous and pair in was_open else run_time
+        partition.entries[pair] = (since, run_time)
+    body = gzip.compress(json.dumps(partition.to_json()).encode())
+    s3.put_object(Body=body, Bucket=bucket_name, Key=partition_key(partition.day))
+    s3.put_object(
+        Body=json.dumps({"day": partition.day.isoformat()}),
+        Bucket=bucket_name,
+        Key=LATEST_KEY,
+    )
+    log.info("Recorded %d issues in %s", len(partition.entries), partition.day)
+    return partition
+
+
+def open_since(s3: Any, bucket_name: str, pair: Pair) -> Optional[datetime]:
+    """When the issue's current streak started, if it's open now."""
+    partition = latest_partition(s3, bucket_name)
+    if partition and partition.is_open(pair):
+        return partition.entries[pair][0]
+    return None
+
+
+def issues_seen_since(
+    s3: Any, bucket_name: str, since: datetime, until: Optional[datetime] = None
+) -> Dict[Pair, Tuple[datetime, datetime]]:
+    """Every issue open at some point since `since`, with its latest streak.
+
+    Only reads one partition per day in the range.
+    """
+    until = until or datetime.utcnow()
+    seen: Dict[Pair, Tuple[datetime, datetime]] = {}
+    days: List[date] = [
+        since.date() + timedelta(days=offset)
+        for offset in range((until.date() - since.date()).days + 1)
+    ]
+    for day in days:
+        partition = read_partition(s3, bucket_name, day)
+        if not partition:
+            continue  # No runs that day
+        for pair, (streak_since, last_seen) in partition.entries.items():
+            if since <= last_seen <= until:
+                seen[pair] = (streak_since, last_seen)
+    return seen
@@ -1,9 +1,27 @@
-from typing import Dict, Optional
+from typing import Any, cast, Dict, Optional, Tuple, Type, TypeVar
+
+T = TypeVar("T", bound="Issue")
+_UNRENDERED = object()
 
 
 class Issue:
+    """An immutable issue with a resource.
+
+    Issues hash and compare as their (issue, resource) pair, so they can be
+    mixed with the tuples in `set_of_issues` and whitelists. Help text is only
+    rendered when first asked for, since it may need a bucket region lookup.
+    """
+
+    __slots__ = ("_resource", "_help")
+    _resource: str
+    _help: Any  # Optional[str] once rendered
+
     def __init__(self, resource: str):
-        self._resource = resource
+        object.__setattr__(self, "_resource", resource)
+        object.__setattr__(self, "_help", _UNRENDERED)
+
+    def __setattr__(self, name: str, value: Any) -> None:
+        raise AttributeError(f"{type(self).__name__} is immutable")
 
     @property
     def issue(self) -> str:
@@ -13,9 +31,37 @@ class Issue:
     def resource(self) -> str:
         return self._resource
 
+    @property
+    def pair(self) -> Tuple[str, str]:
+        return (self.issue, self.resource)
+
+    def render_help(self) -> Optional[str]:
+        return None
+
     @property
     def help(self) -> Optional[str]:
-        pass
+        if self._help is _UNRENDERED:
+            object.__setattr__(self, "_help", self.render_help())
+        return cast(Optional[str], self._help)
+
+    def __eq__(self, other: object) -> bool:
+        if isinstance(other, Issue):
+            return self.pair == other.pair
+        return self.pair == other
+
+    def __hash__(self) -> int:
+        return hash(self.pair)
+
+    def __repr__(self) -> str:
+        return f"{self.issue}({self.resource!r})"
+
+    def to_json(self, include_help: bool = True) -> Dict[str, Optional[str]]:
+        fields: Dict[str, Optional[str]] = {
+            "issue": self.issue,
+            "resource": self.resource,
+        }
+        return {**fields, "help": self.help} if include_help else fields
 
-    def to_json(self) -> Dict[str, Optional[str]]:
-        return {"issue": self.issue, "resource": self.resource, "help": self.help}
+    @classmethod
+    def from_json(cls: Type[T], fields: Dict[str, Any]) -> T:
+        return cls(fields["resource"])
@@ -0,0 +1,110 @@
+import gzip
+import json
+from types import TracebackType
+from typing import Any, BinaryIO, Dict, Generator, IO, Optional, Tuple, Type
+
+from json_dumper import dumps
+
+FORMAT = "jsonl"
+SUFFIX = ".jsonl.gz"
+
+
+class OutputWriter:
+    """Writes run output as gzipped JSON Lines, a record per line, as the run goes.
+
+    The "run" record comes first, then "issue", "inconclusive" and "skipped"
+    records as probes finish or are skipped, then a "bucket" record per bucket
+    and last the "summary" record with the end time, metrics and anything
+    else. Issues have no help text; `issue_help` derives it when reading.
+    """
+
+    def __init__(self, fileobj: BinaryIO) -> None:
+        self._gzip = gzip.GzipFile(fileobj=fileobj, mode="wb")
+
+    def write(self, record: str, **fields: Any) -> None:
+        self._gzip.write(dumps({"record": record, **fields}).encode() + b"\n")
+
+    def write_issue(self, issue: Dict[str, Any]) -> None:
+        self.write("issue", **{k: v for k, v in issue.items() if k != "help"})
+
+    def write_buckets_and_summary(self, output: Dict[str, Any]) -> None:
+        for name, state in output.get("buckets", {}).items():
+            self.write("bucket", name=name, **state)
+        summary = {
+            k: v
+            for k, v in output.items()
+            if k
+            not in (
+                "start_time",
+                "tests",
+                "issues",
+                "inconclusive",
+                "skipped",
+                "buckets",
+            )
+        }
+        self.write("summary", **summary)
+
+    def close(self) -> None:
+        self._gzip.close()  # Leaves fileobj open
+
+    def __enter__(self) -> "OutputWriter":
+        return self
+
+    def __exit__(
+        self,
+        exc_type: Optional[Type[BaseException]],
+        exc: Optional[BaseException],
+        traceback: Optional[TracebackType],
+    ) -> None:
+        self.close()
+
+
+def write_output(fileobj: BinaryIO, output: Dict[str, Any]) -> None:
+    """Write a whole output, e.g. a merged sharded one, in one go."""
+    with OutputWriter(fileobj) as writer:
+        writer.write("run", start_time=output["start_time"], tests=output["tests"])
+        for issue in output["issues"]:
+            writer.write_issue(issue)
+        for kind in ("inconclusive", "skipped"):
+            for entry in output.get(kind, []):
+                writer.write(kind, **entry)
+        writer.write_buckets_and_summary(output)
+
+
+def read_records(body: IO[bytes]) -> Generator[Dict[str, Any], None, None]:
+    """Stream the records of a JSON Lines output, decompressing as we go."""
+    with gzip.GzipFile(fileobj=body, mode="rb") as lines:
+        for line in lines:
+            yield json.loads(line)
+
+
+def read_issues(body: IO[bytes]) -> Generator[Dict[str, Any], None, None]:
+    """Stream just the issue records, e.g. to diff against, without building
+    the rest of the output. An issue found twice is yielded twice."""
+    for record in read_records(body):
+        if record.pop("record") == "issue":
+            yield record
+
+
+def read_output(body: IO[bytes]) -> Dict[str, Any]:
+    """Read a JSON Lines output into the same shape as a JSON one."""
+    output: Dict[str, Any] = {
+        "issues": [],
+        "inconclusive": [],
+        "skipped": [],
+        "buckets": {},
+    }
+    issues: Dict[Tuple[str, str, str], Dict[str, Any]] = {}
+    for record in read_records(body):
+        kind = record.pop("record")
+        if kind == "issue":  # The last record of an issue found twice is kept
+            issues[(record["test"], record["issue"], record["resource"])] = record
+        elif kind in ("inconclusive", "skipped"):
+            output[kind].append(record)
+        elif kind == "bucket":
+            output["buckets"][record.pop("name")] = record
+        else:  # run or summary
+            output.update(record)
+    output["issues"] = list(issues.values())
+    return output
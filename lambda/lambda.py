@@ -1,48 +1,181 @@
+# Each handler imports what it needs when first invoked, so that neither pays
+# the cold start import time of the other's dependencies
+# pylint: disable=import-outside-toplevel
 import logging
 import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+from functools import lru_cache
 
-from config import ConfigGenerator, get_configs
-from run import get_whitelist, key_from_output, set_of_issues, TestRunner
-
-from slack import send_diff_message, send_full_message
+from metrics import metrics
 
 log = logging.getLogger(__name__)
 
+
 def initialise_logging():
     root_logger = logging.getLogger()
     root_logger.setLevel(logging.INFO)
 
 
 def config_handler(event, context):  # pylint: disable=unused-argument
+    from config import ConfigGenerator
+
     initialise_logging()
     config_generator = ConfigGenerator(os.environ["CONFIG_BUCKET"])
-    config_generator.generate_and_upload()
+    pages = os.environ.get("SAMPLE_PAGES", "1")
+    config_generator.generate_and_upload(
+        pages_to_request=None if pages == "all" else int(pages),
+        listing_workers=int(os.environ.get("LISTING_WORKERS", "16")),
+    )
     return {"statusCode": 200}
 
 
-def run_handler(event, context):  # pylint: disable=unused-argument
-    initialise_logging()
-    config_bucket_name = os.environ["CONFIG_BUCKET"]
+@lru_cache(maxsize=1)
+def probe_client(pool_connections, pool_maxsize, timeout, retries, max_rate):
+    """A probe client per setting, so warm invocations keep its open connections."""
+    from probe_client import ProbeClient
+    from throttle import Endpoints
+
+    return ProbeClient(
+        pool_connections=pool_connections,
+        pool_maxsize=pool_maxsize,
+        timeout=timeout,
+        retries=retries,
+        endpoints=Endpoints(max_rate=max_rate),
+    )
+
+
+def configure_probing():
+    """Set up the shared probe client and return TestRunner options from env vars."""
+    from probe_client import set_client
+
+    max_per_endpoint = int(os.environ.get("MAX_PER_ENDPOINT", "4"))
+    set_client(
+        probe_client(
+            int(os.environ.get("PROBE_POOL_CONNECTIONS", "256")),
+            max_per_endpoint,  # Requests to a host are bounded by the engine
+            float(os.environ.get("PROBE_TIMEOUT", "10")),
+            int(os.environ.get("PROBE_RETRIES", "3")),
+            float(os.environ.get("PROBE_MAX_RATE", "500")),
+        )
+    )
+    return {
+        "max_workers": int(os.environ.get("MAX_WORKERS", "16")),
+        "max_per_endpoint": max_per_endpoint,
+        "region_ttl": timedelta(
+            days=int(os.environ.get("REGION_CACHE_TTL_DAYS", "30"))
+        ),
+        "max_age": (
+            timedelta(hours=int(os.environ["INCREMENTAL_MAX_AGE_HOURS"]))
+            if os.environ.get("INCREMENTAL_MAX_AGE_HOURS")
+            else None
+        ),
+        "verify_all": bool(os.environ.get("VERIFY_ALL")),
+        "output_format": os.environ.get("OUTPUT_FORMAT", "json"),
+    }
+
+
+def notify(test_runner, output, whitelist):
+    """Send the run's issues, or what changed since the last run, to Slack.
+
+    The previous run is still found if the upload has already replaced it.
+    """
+    from run import bucket_owners, key_from_output, set_of_issues
+    from slack import send_diff_message, send_full_message
+
     output_bucket_name = os.environ["OUTPUT_BUCKET"]
-    log.info("## Getting configs")
-    configs = get_configs(config_bucket_name)
-    test_runner = TestRunner(output_bucket_name, *configs.values())
-    output = test_runner.run_and_upload(
-        accounts=[k.split(".")[0] for k in configs.keys()]  # 123.json -> 123
+    owners = (
+        bucket_owners(output) if os.environ.get("SLACK_GROUP_BY") == "account" else None
     )
-    log.info("## Output:")
-    log.info(output)
-    log.info("## Getting whitelist")
-    whitelist = get_whitelist(config_bucket_name)
-    log.info(whitelist)
     if os.environ.get("DIFF_ONLY"):
-        new, fixed = test_runner.diff_previous_s3(output, whitelist)
-        send_diff_message(new, fixed, output_bucket_name, key_from_output(output))
+        with metrics.timer("phase.previous_output_diff"):
+            new, fixed = test_runner.diff_previous_s3(output, whitelist)
+        with metrics.timer("phase.slack"):
+            send_diff_message(
+                new, fixed, output_bucket_name, key_from_output(output), owners
+            )
     else:
         log.info("## Sending to slack")
-        send_full_message(
-            set_of_issues(output, whitelist),
-            output_bucket_name,
-            key_from_output(output),
-        )
+        with metrics.timer("phase.slack"):
+            send_full_message(
+                set_of_issues(output, whitelist),
+                output_bucket_name,
+                key_from_output(output),
+                owners,
+            )
+
+
+def run_handler(event, context):  # pylint: disable=too-many-locals
+    from checkpoint import Checkpoint
+    from config import account_from_key, get_configs, iter_configs
+    from run import get_whitelist, TestRunner, upload_output
+    from shard import LambdaExecutor, run_sharded, run_worker
+
+    initialise_logging()
+    config_bucket_name = os.environ["CONFIG_BUCKET"]
+    output_bucket_name = os.environ["OUTPUT_BUCKET"]
+    runner_options = configure_probing()
+    if context:  # Leave time to upload the output and notify after probing
+        margin = float(os.environ.get("DEADLINE_MARGIN_SECONDS", "60"))
+        remaining = context.get_remaining_time_in_millis() / 1000
+        runner_options["deadline"] = time.monotonic() + remaining - margin
+    metrics.reset()  # Warm containers keep module state between invocations
+    try:
+        log.info("## Getting whitelist")
+        with metrics.timer("phase.whitelist_fetch"):
+            whitelist = get_whitelist(config_bucket_name)
+        log.info(whitelist)
+        runner_options["whitelist"] = whitelist  # Skips probing whitelisted issues
+        if "shard_key" in event:  # Invoked as a worker by a sharded run
+            run_worker(output_bucket_name, event["shard_key"], **runner_options)
+            return {"statusCode": 200}
+        # Slack is told about the output while it's uploaded, rather than after
+        with ThreadPoolExecutor(max_workers=1) as notifier:
+            notifications = []
+
+            def on_output(output):
+                notifications.append(
+                    notifier.submit(notify, test_runner, output, whitelist)
+                )
+
+            if os.environ.get("SHARD_SIZE"):
+                log.info("## Getting configs")
+                configs = get_configs(config_bucket_name)
+                test_runner = TestRunner(output_bucket_name, **runner_options)
+                executor = LambdaExecutor(
+                    output_bucket_name,
+                    os.environ.get("WORKER_FUNCTION", context.function_name),
+                )
+                with metrics.timer("phase.shards"):
+                    output = run_sharded(
+                        configs,
+                        executor,
+                        int(os.environ["SHARD_SIZE"]),
+                        accounts=[account_from_key(key) for key in configs],
+                    )
+                if runner_options["output_format"] == "jsonl":
+                    output["format"] = "jsonl"  # Shards' partial outputs stay JSON
+                on_output(output)
+                upload_output(output_bucket_name, output)
+            else:
+                log.info("## Streaming configs into the runner")
+                test_runner = TestRunner(
+                    output_bucket_name,
+                    config_stream=iter_configs(config_bucket_name),
+                    checkpoint=Checkpoint(
+                        output_bucket_name,
+                        interval=float(os.environ.get("CHECKPOINT_INTERVAL", "60")),
+                    ),
+                    **runner_options,
+                )
+                output = test_runner.run_and_upload(on_output)
+            log.info("## Output:")
+            log.info(output)
+            for notification in notifications:
+                notification.result()  # Raises if sending failed
+    finally:  # After the last phase, so that every phase is in the metrics
+        if os.environ.get("EMF_NAMESPACE"):
+            for line in metrics.emf_lines(os.environ["EMF_NAMESPACE"]):
+                print(line)  # CloudWatch picks up EMF from raw stdout lines
     return {"statusCode": 200}
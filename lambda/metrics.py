@@ -0,0 +1,153 @@
+import json
+import threading
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+from functools import wraps
+from typing import Any, Callable, Dict, Generator, List, Optional, TypeVar, Union
+
+F = TypeVar("F", bound=Callable[..., Any])
+
+# Upper bounds of the latency histogram buckets, in seconds
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+class Histogram:
+    def __init__(self) -> None:
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+        self.buckets = [0] * (len(LATENCY_BUCKETS) + 1)  # Last one is overflow
+
+    def observe(self, seconds: float) -> None:
+        self.count += 1
+        self.sum += seconds
+        self.max = max(self.max, seconds)
+        self.buckets[bisect_left(LATENCY_BUCKETS, seconds)] += 1
+
+    def to_json(self) -> Dict[str, Any]:
+        return {
+            "count": self.count,
+            "sum": self.sum,
+            "max": self.max,
+            "buckets": {
+                str(bound): count
+                for bound, count in zip(LATENCY_BUCKETS + ("inf",), self.buckets)
+            },
+        }
+
+
+class Metrics:
+    """Thread-safe counters and latency histograms for one run."""
+
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        self._current = threading.local()
+        self.counters: Dict[str, int] = {}
+        self.histograms: Dict[str, Histogram] = {}
+
+    def reset(self) -> None:
+        with self._lock:
+            self.counters = {}
+            self.histograms = {}
+
+    def increment(self, name: str, value: int = 1) -> None:
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def observe(self, name: str, seconds: float) -> None:
+        with self._lock:
+            self.histograms.setdefault(name, Histogram()).observe(seconds)
+
+    @contextmanager
+    def timer(self, name: str) -> Generator[None, None, None]:
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start)
+
+    @property
+    def current_probe(self) -> Optional[str]:
+        """Name of the instrumented probe running on this thread, if any."""
+        return getattr(self._current, "probe", None)
+
+    def record_response(self, status: Union[int, str], retries: int) -> None:
+        """Count a response by status code, or a failure by exception name."""
+        probe = self.current_probe or "unattributed"
+        self.increment(f"{probe}.status.{status}")
+        if retries:
+            self.increment(f"{probe}.retries", retries)
+
+    def instrumented(self, func: F) -> F:
+        """Count calls and errors of func and record its latency."""
+        name = func.__name__
+
+        @wraps(func)
+        def wrapper(*args: Any, **kwargs: Any) -> Any:
+            outer_probe = self.current_probe
+            self._current.probe = name
+            self.increment(f"{name}.calls")
+            try:
+                with self.timer(f"{name}.latency"):
+                    return func(*args, **kwargs)
+            except Exception:
+                self.increment(f"{name}.errors")
+                raise
+            finally:
+                self._current.probe = outer_probe
+
+        return wrapper  # type: ignore
+
+    def snapshot(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                "counters": dict(self.counters),
+                "histograms": {
+                    name: histogram.to_json()
+                    for name, histogram in self.histograms.items()
+                },
+            }
+
+    def emf_lines(self, namespace: str) -> List[str]:
+        """Render as CloudWatch Embedded Metric Format log lines."""
+        values: Dict[str, Any] = {}
+        units: Dict[str, str] = {}
+        with self._lock:
+            for name, count in self.counters.items():
+                values[name] = count
+                units[name] = "Count"
+            for name, histogram in self.histograms.items():
+                bounds = [1000 * bound for bound in LATENCY_BUCKETS]
+                bounds.append(1000 * histogram.max)  # Overflow bucket
+                values[name] = {
+                    "Values": [b for b, c in zip(bounds, histogram.buckets) if c],
+                    "Counts": [c for c in histogram.buckets if c],
+                }
+                units[name] = "Milliseconds"
+        names = sorted(values)
+        timestamp = int(time.time() * 1000)
+        return [
+            json.dumps(
+                {
+                    "_aws": {
+                        "Timestamp": timestamp,
+                        "CloudWatchMetrics": [
+                            {
+                                "Namespace": namespace,
+                                "Dimensions": [[]],
+                                "Metrics": [
+                                    {"Name": name, "Unit": units[name]}
+                                    for name in chunk
+                                ],
+                            }
+                        ],
+                    },
+                    **{name: values[name] for name in chunk},
+                }
+            )
+            for chunk in (names[i : i + 100] for i in range(0, len(names), 100))
+        ]
+
+
+metrics = Metrics()
@@ -0,0 +1,136 @@
+import logging
+import random
+import time
+from typing import Any, Optional, TYPE_CHECKING
+from urllib.parse import urlparse
+
+from metrics import metrics
+from throttle import Endpoints
+
+if TYPE_CHECKING:
+    import requests  # Imported when a client is made: config jobs never make one
+
+log = logging.getLogger(__name__)
+THROTTLING_STATUSES = (429, 503)
+
+
+class ProbeError(Exception):
+    """A probe couldn't get an answer out of S3, so its result is inconclusive."""
+
+
+class ProbeClient:
+    """Keep-alive HTTP client shared by all the anonymous S3 probes.
+
+    Connections are pooled per host (one pool per regional endpoint or bucket
+    host), so the TCP and TLS handshakes are paid once per host rather than
+    once per probe. 503 SlowDown responses and connection errors are retried
+    with jittered exponential backoff, honouring Retry-After when S3 sends it.
+
+    Requests to each host are paced by an adaptive rate limiter, which backs
+    off when the host throttles us, and go through a circuit breaker, which
+    refuses them for a while once the host keeps failing. Requests which
+    still fail raise ProbeError.
+    """
+
+    def __init__(  # pylint: disable=too-many-arguments
+        self,
+        pool_connections: int = 256,
+        pool_maxsize: int = 4,
+        timeout: float = 10.0,
+        retries: int = 3,
+        backoff: float = 0.2,
+        endpoint_url: Optional[str] = None,
+        endpoints: Optional[Endpoints] = None,
+    ) -> None:
+        self.endpoint_url = endpoint_url  # e.g. a local stand-in for S3 in tests
+        self._timeout = timeout
+        self._retries = retries
+        self._backoff = backoff
+        self._endpoints = endpoints or Endpoints()
+        import requests  # pylint: disable=import-outside-toplevel,redefined-outer-name
+        from requests.adapters import (  # pylint: disable=import-outside-toplevel
+            HTTPAdapter,
+        )
+
+        self._request_exception = requests.RequestException
+        self._session = requests.Session()
+        adapter = HTTPAdapter(
+            pool_connections=pool_connections, pool_maxsize=pool_maxsize
+        )
+        self._session.mount("https://", adapter)
+        self._session.mount("http://", adapter)
+
+    def request(self, method: str, url: str, **kwargs: Any) -> "requests.Response":
+        kwargs.setdefault("timeout", self._timeout)
+        host = urlparse(url).netloc
+        limiter, breaker = self._endpoints.get(host)
+        if not breaker.allow():
+            metrics.record_response("circuit_open", 0)
+            raise ProbeError(f"Circuit open for {host}, not sending {method} {url}")
+        attempt = 0
+        while True:
+            limiter.acquire()
+            response: Optional["requests.Response"] = None
+            try:
+                response = self._session.request(method, url, **kwargs)
+                outcome = str(response.status_code)
+            except self._request_exception as e:
+                outcome = type(e).__name__
+            if response is not None:
+                if response.status_code not in THROTTLING_STATUSES:
+                    limiter.on_success()
+                    breaker.record_success()
+                    metrics.record_response(response.status_code, attempt)
+                    return response
+                limiter.on_throttle()
+                response.close()
+            if attempt >= self._retries:
+                metrics.record_response(outcome, attempt)
+                if breaker.record_failure():
+                    log.warning("Opened the circuit for %s", host)
+                    metrics.increment("circuit_opened")
+                raise ProbeError(
+                    f"{method} {url} failed {attempt + 1} times: {outcome}"
+                )
+            delay = self._retry_delay(attempt, response)
+            log.debug("%s from %s %s, retrying in %.2fs", outcome, method, url, delay)
+            time.sleep(delay)
+            attempt += 1
+
+    def _retry_delay(
+        self, attempt: int, response: Optional["requests.Response"]
+    ) -> float:
+        retry_after = response.headers.get("Retry-After", "") if response else ""
+        if retry_after.isdigit():
+            return float(retry_after)
+        return self._backoff * 2**attempt * random.uniform(0.5, 1.5)
+
+    def get(self, url: str, **kwargs: Any) -> "requests.Response":
+        return self.request("GET", url, **kwargs)
+
+    def head(self, url: str, **kwargs: Any) -> "requests.Response":
+        kwargs.setdefault("allow_redirects", False)  # Same default as requests.head
+        return self.request("HEAD", url, **kwargs)
+
+    def put(self, url: str, **kwargs: Any) -> "requests.Response":
+        return self.request("PUT", url, **kwargs)
+
+    def delete(self, url: str, **kwargs: Any) -> "requests.Response":
+        return self.request("DELETE", url, **kwargs)
+
+
+_client: Optional[ProbeClient] = None
+
+
+def get_client() -> ProbeClient:
+    """The probe client shared across probes and warm Lambda invocations."""
+    global _client  # pylint: disable=global-statement
+    if _client is None:
+        _client = ProbeClient()
+    return _client
+
+
+def set_client(client: ProbeClient) -> None:
+    """Replace the shared probe client, e.g. to tune it or to point it at a fake S3."""
+    global _client  # pylint: disable=global-statement
+    _client = client
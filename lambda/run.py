@@ -1,29 +1,113 @@
 import os
 import sys
 
+import gzip
 import json
 import logging
+import tempfile
 from datetime import datetime, timedelta
-from typing import Any, cast, Dict, Generator, List, NewType, Optional, Set, Tuple
+from typing import (
+    Any,
+    Callable,
+    cast,
+    Dict,
+    Generator,
+    Hashable,
+    IO,
+    Iterable,
+    List,
+    NewType,
+    Optional,
+    Set,
+    Tuple,
+)
 
-import boto3
 from botocore.exceptions import ClientError
 import requests
 
+from analysis import classify, IMPOSSIBLE
+import clients
+from config import account_from_key
+from checkpoint import Checkpoint, ProbeKey
+from engine import Inconclusive, Probe, ProbeEngine, ProbeResult, Unprobed
+from history import update_history
+from issues import Issue
 from json_dumper import dumps
+import jsonl_output
+from jsonl_output import OutputWriter
+from metrics import metrics
 from s3_bucket_inspector import (
+    BucketTest,
+    issue_help,
     PubliclyDeletableBuckets,
     PubliclyListableBuckets,
     PubliclyReadableFiles,
     PubliclyUploadableBuckets,
+    seed_bucket_regions,
+    WriteProbes,
 )
+from whitelist import Whitelist
 
 log = logging.getLogger(__name__)
 Output = NewType("Output", Dict[str, Any])
-Whitelist = NewType("Whitelist", Set[Tuple[str, str]])
+ResultOrder = Tuple[int, str, int]  # Test, config key, bucket
+OutputOrder = Tuple[ResultOrder, ResultOrder]  # Lowest listing config's, then own
+INDEX_PREFIX = "index/"
+LATEST_KEY = f"{INDEX_PREFIX}latest.json"  # Points to the last run's output and index
+# Reasons a probe was skipped, besides IMPOSSIBLE. Skipped for these, it says
+# nothing about whether the bucket still has the issue
+WHITELISTED = "whitelisted"
+DEADLINE = "deadline"
+UNVERIFIED_REASONS = (WHITELISTED, DEADLINE)
+
+
+def probe_key(order: ResultOrder, probe: Probe) -> ProbeKey:
+    """A probe's key in checkpoints: its test, config key and bucket."""
+    return (type(probe.test).__name__, order[1], probe.bucket_name)
+
+
+class PreviousRun:
+    """The previous run's results, to carry forward and to prioritise probes by."""
+
+    def __init__(self, output: Output, oldest: Optional[datetime]) -> None:
+        self._states: Dict[str, Dict[str, Any]] = output.get("buckets", {})
+        self._oldest = oldest
+        self._issues: Dict[Tuple[str, str], List[Dict]] = {}
+        self._open = {issue["resource"] for issue in output["issues"]}
+        for issue in output["issues"]:
+            issues = self._issues.setdefault((issue["test"], issue["resource"]), [])
+            if issue not in issues:  # Buckets in several configs repeat issues
+                issues.append(issue)
+
+    def verified_time(
+        self, test_name: str, bucket_name: str, fingerprint: Optional[str]
+    ) -> Optional[datetime]:
+        """When the test last probed the bucket, if recently enough and it's unchanged."""
+        state = self._states.get(bucket_name)
+        if not state or not fingerprint or state["fingerprint"] != fingerprint:
+            return None
+        if test_name not in state.get("tests", []):  # Skipped or unverified
+            return None
+        verified_time = parse_time(state["verified_time"])
+        if self._oldest is None or verified_time < self._oldest:
+            return None
+        return verified_time
+
+    def priority(self, bucket_name: str, fingerprint: Optional[str]) -> Tuple[int, str]:
+        """Sort key putting buckets with open issues first, then buckets which
+        changed, then the least recently verified."""
+        if bucket_name in self._open:
+            return (0, "")
+        state = self._states.get(bucket_name)
+        if not state or not fingerprint or state["fingerprint"] != fingerprint:
+            return (1, "")
+        return (2, parse_time(state["verified_time"]).isoformat())
+
+    def issues(self, test_name: str, bucket_name: str) -> List[Dict]:
+        return self._issues.get((test_name, bucket_name), [])
 
 
-class TestRunner:
+class TestRunner:  # pylint: disable=too-many-instance-attributes
     """Takes per-account config files and runs tests against the buckets."""
 
     test_classes = (
@@ -33,62 +117,455 @@ class TestRunner:
         PubliclyDeletableBuckets,
     )
 
-    def __init__(self, output_bucket_name: str, *configs: Any):
+    def __init__(  # pylint: disable=too-many-arguments
+        self,
+        output_bucket_name: str,
+        *configs: Any,
+        config_stream: Optional[Iterable[Tuple[str, Dict[str, Any]]]] = None,
+        max_workers: int = 16,
+        max_per_endpoint: int = 4,
+        region_ttl: timedelta = timedelta(days=30),
+        max_age: Optional[timedelta] = None,
+        verify_all: bool = False,
+        output_format: str = "json",
+        whitelist: Optional[Whitelist] = None,
+        checkpoint: Optional[Checkpoint] = None,
+        deadline: Optional[float] = None,
+    ):
+        """Configs can instead be streamed as (config key, config) pairs."""
         self._bucket_name = output_bucket_name
-        self._tests = [cls(**config) for cls in self.test_classes for config in configs]
+        self._streamed = config_stream is not None
+        self._configs = (
+            config_stream
+            if config_stream is not None
+            else [(f"{i:06}", config) for i, config in enumerate(configs)]
+        )
+        self.config_keys: List[str] = []
+        self._fingerprints: Dict[str, str] = {}
+        self._region_ttl = region_ttl
+        self._tests: List[BucketTest] = []
+        # (Test, bucket) pairs verified by probing, or carried forward from then
+        self._probed: Set[Tuple[str, str]] = set()
+        self._verified_times: Dict[Tuple[str, str], datetime] = {}
+        self._unverified: Set[Tuple[str, str]] = set()
+        self._previous_run: Optional[PreviousRun] = None
+        self._writer: Optional[OutputWriter] = None
+        self._carried: List[Tuple[ResultOrder, List[Dict]]] = []
+        self._found: List[Tuple[ResultOrder, str, Issue]] = []
+        self._written: Dict[Tuple[str, str, str], OutputOrder] = {}
+        self._inconclusive: List[Tuple[ResultOrder, Dict[str, str]]] = []
+        self._engine = ProbeEngine(max_workers, max_per_endpoint, deadline)
+        self._deadline = deadline
+        self._max_age = max_age
+        self._verify_all = verify_all
+        self._access: Dict[str, Dict[str, Any]] = {}
+        self._write_probes = WriteProbes()  # Shared by the upload and delete tests
+        self._output_format = output_format
+        # Accounts whose configs list each bucket
+        self._owners: Dict[str, List[str]] = {}
+        # Work of each test index scheduled already, by whichever config came first
+        self._scheduled: Set[Tuple[int, Hashable]] = set()
+        # Lowest place of each test index and bucket, over the configs listing it
+        self._first_orders: Dict[Tuple[int, str], ResultOrder] = {}
+        self._whitelist = whitelist
+        self._skipped: List[Tuple[ResultOrder, Dict[str, str]]] = []
+        self._checkpoint = checkpoint
+
+    def _probes(self) -> Generator[Tuple[ResultOrder, Probe], None, None]:
+        """Every (test, bucket) probe, with its place in the output, as configs arrive.
+
+        A bucket listed by several configs is probed by whichever arrives
+        first, and the others only probe work (e.g. random files) not covered
+        yet. Results are placed by the lowest config key listing the bucket.
+        """
+        for config_key, config in self._configs:
+            self.config_keys.append(config_key)
+            seed_bucket_regions(config.get("s3_bucket_regions", {}), self._region_ttl)
+            self._fingerprints.update(config.get("s3_bucket_fingerprints", {}))
+            self._access.update(config.get("s3_bucket_access", {}))
+            if self._streamed:  # Keys of given configs aren't account ids
+                account = account_from_key(config_key)
+                for bucket_name in config.get("s3_bucket_list", []):
+                    owners = self._owners.setdefault(bucket_name, [])
+                    if account not in owners:
+                        owners.append(account)
+            for test_index, cls in enumerate(self.test_classes):
+                test = cls(**config, write_probes=self._write_probes)
+                self._tests.append(test)
+                for bucket_index, bucket_name in enumerate(test.buckets):
+                    order = (test_index, config_key, bucket_index)
+                    first = self._first_orders.setdefault(
+                        (test_index, bucket_name), order
+                    )
+                    self._first_orders[(test_index, bucket_name)] = min(first, order)
+                    work = test.work(bucket_name)
+                    new_work = [
+                        item
+                        for item in work
+                        if (test_index, item) not in self._scheduled
+                    ]
+                    if work and not new_work:
+                        metrics.increment("probes.deduplicated")
+                        continue
+                    if len(new_work) < len(work):
+                        test.restrict(bucket_name, new_work)
+                    self._scheduled.update((test_index, item) for item in new_work)
+                    yield order, Probe(test, bucket_name)
+
+    def _skip_reason(self, probe: Probe) -> Optional[str]:
+        if self._verify_all:
+            return None
+        bucket_name = probe.bucket_name
+        if self._whitelist and self._whitelist.matches(
+            probe.test.issue_class.__name__,
+            bucket_name,
+            self._owners.get(bucket_name, []),
+        ):
+            return WHITELISTED
+        return IMPOSSIBLE if self._impossible(probe) else None
+
+    def _impossible(self, probe: Probe) -> bool:
+        verdict = classify(
+            self._access.get(probe.bucket_name),
+            probe.test.action,
+            probe.test.acl_permissions,
+        )
+        return verdict == IMPOSSIBLE
+
+    def _get_issues(self) -> List[Dict]:
+        """Run the probes, writing each result to the writer, if any, as it comes in."""
+        priority = self._priority if self._previous_run else None
+        for order, probe, result in self._engine.run(self._probes_to_run(), priority):
+            self._record(order, probe, result)
+            if self._checkpoint and not isinstance(result, Unprobed):
+                self._checkpoint.add(probe_key(order, probe), result)
+        if self._verified_times:
+            log.info(
+                "Carried forward %d results of unchanged buckets",
+                len(self._verified_times),
+            )
+        return self._collect_issues()
 
-    def _get_issues(self) -> Generator[Dict, None, None]:
-        for test in self._tests:
-            for issue in test.find_issues():
-                log.info("Found %s with resource '%s'", issue.issue, issue.resource)
-                yield {"test": type(test).__name__, **issue.to_json()}
+    def _probes_to_run(self) -> Generator[Tuple[ResultOrder, Probe], None, None]:
+        """The probes to send, skipping, carrying forward or resuming the rest."""
+        for order, probe in self._probes():
+            reason = self._skip_reason(probe)
+            if reason:  # Not probed, nor carried forward as verified
+                metrics.increment(
+                    "probes.whitelisted" if reason == WHITELISTED else "probes.pruned"
+                )
+                self._skip(order, probe, reason)
+                if reason == WHITELISTED:
+                    self._carry_unverified(order, probe)
+            elif self._carry_forward(order, probe):
+                continue
+            elif self._checkpoint and probe_key(order, probe) in self._checkpoint:
+                metrics.increment("probes.resumed")
+                self._record(
+                    order, probe, self._checkpoint.get(probe_key(order, probe))
+                )
+            else:
+                yield order, probe
 
-    def run(self, **extra: Any) -> Output:
-        """Run the tests and return output."""
+    def _carry_forward(self, order: ResultOrder, probe: Probe) -> bool:
+        """Carry the previous result forward if the bucket is unchanged since."""
+        if not self._previous_run or self._verify_all:
+            return False
+        pair = (type(probe.test).__name__, probe.bucket_name)
+        verified_time = self._previous_run.verified_time(
+            *pair, self._fingerprints.get(probe.bucket_name)
+        )
+        if not verified_time:
+            return False
+        self._verified_times[pair] = min(
+            verified_time, self._verified_times.get(pair, verified_time)
+        )
+        self._add_carried(order, self._previous_run.issues(*pair))
+        return True
+
+    def _carry_unverified(self, order: ResultOrder, probe: Probe) -> None:
+        """Keep the previous run's issues for a probe which couldn't tell whether
+        they're fixed, so that they aren't reported as new once it can."""
+        if self._previous_run:
+            test_name = type(probe.test).__name__
+            issues = self._previous_run.issues(test_name, probe.bucket_name)
+            self._add_carried(order, issues)
+
+    def _add_carried(self, order: ResultOrder, issues: List[Dict]) -> None:
+        self._carried.append((order, issues))
+        for issue in issues:
+            self._write_issue(order, issue)
+
+    def _skip(self, order: ResultOrder, probe: Probe, reason: str) -> None:
+        entry = {
+            "test": type(probe.test).__name__,
+            "resource": probe.bucket_name,
+            "reason": reason,
+        }
+        self._skipped.append((order, entry))
+        if self._writer:
+            self._writer.write("skipped", **entry)
+
+    def _record(self, order: ResultOrder, probe: Probe, result: ProbeResult) -> None:
+        test_name = type(probe.test).__name__
+        if isinstance(result, (Unprobed, Inconclusive)):
+            self._unverified.add((test_name, probe.bucket_name))
+            self._carry_unverified(order, probe)
+        else:
+            self._probed.add((test_name, probe.bucket_name))
+        if isinstance(result, Unprobed):
+            self._skip(order, probe, DEADLINE)
+        elif isinstance(result, Inconclusive):
+            entry = {
+                "test": test_name,
+                "resource": probe.bucket_name,
+                "error": result.error,
+            }
+            self._inconclusive.append((order, entry))
+            if self._writer:
+                self._writer.write("inconclusive", **entry)
+        elif result:
+            log.info("Found %s with resource '%s'", result.issue, result.resource)
+            self._found.append((order, test_name, result))
+            self._write_issue(order, {"test": test_name, **result.to_json(False)})
+
+    def _write_issue(self, order: ResultOrder, issue: Dict[str, Any]) -> None:
+        """Write the issue unless a config earlier in the output found it.
+        Readers keep the last record of an issue found by several."""
+        key = (issue["test"], issue["issue"], issue["resource"])
+        output_order = self._output_order(order, issue["resource"])
+        if self._writer and (
+            key not in self._written or output_order < self._written[key]
+        ):
+            self._written[key] = output_order
+            self._writer.write_issue(issue)
+
+    def _priority(self, probe: Probe) -> Tuple[int, str]:
+        return cast(PreviousRun, self._previous_run).priority(
+            probe.bucket_name, self._fingerprints.get(probe.bucket_name)
+        )
+
+    def _output_order(self, order: ResultOrder, bucket_name: str) -> OutputOrder:
+        """Where the lowest config listing the bucket puts a result, then where
+        the config which probed it does."""
+        return self._first_orders.get((order[0], bucket_name), order), order
+
+    def _in_output_order(
+        self, results: List[Tuple[ResultOrder, Dict[str, Any]]]
+    ) -> List[Dict[str, Any]]:
+        results = sorted(
+            results,
+            key=lambda result: self._output_order(result[0], result[1]["resource"]),
+        )
+        return [entry for _, entry in results]
+
+    def _collect_issues(self) -> List[Dict]:
+        """Issues in output order, keeping the first of any found twice."""
+        include_help = self._writer is None
+        # Help texts are only rendered now, once probing no longer waits on them
+        results = [
+            (order, issue) for order, issues in self._carried for issue in issues
+        ] + [
+            (order, {"test": test_name, **issue.to_json(include_help)})
+            for order, test_name, issue in self._found
+        ]
+        issues: Dict[Tuple[str, str, str], Dict] = {}
+        for issue in self._in_output_order(results):
+            if include_help and "help" not in issue:  # Carried from an index
+                issue = {**issue, "help": issue_help(issue)}
+            issues.setdefault((issue["test"], issue["issue"], issue["resource"]), issue)
+        return list(issues.values())
+
+    def _bucket_states(self, now: datetime) -> Dict[str, Dict[str, Any]]:
+        """Fingerprint of each bucket, the tests which verified it and when the
+        longest ago of them did.
+
+        Tests skipped, inconclusive or unprobed on a bucket aren't listed, so
+        that the next incremental run doesn't carry their results forward.
+        """
+        verified: Dict[str, Dict[str, datetime]] = {}
+        for test_name, bucket_name in (self._probed | set(self._verified_times)) - (
+            self._unverified
+        ):
+            verified.setdefault(bucket_name, {})[test_name] = self._verified_times.get(
+                (test_name, bucket_name), now
+            )
+        return {
+            bucket_name: {
+                "fingerprint": self._fingerprints.get(bucket_name),
+                "verified_time": min(verified[bucket_name].values()),
+                "tests": sorted(verified[bucket_name]),
+            }
+            for test in self._tests
+            for bucket_name in test.buckets
+            if bucket_name in verified
+        }
+
+    def run(
+        self,
+        previous_output: Optional[Output] = None,
+        writer: Optional[OutputWriter] = None,
+        **extra: Any,
+    ) -> Output:
+        """Run the tests and return output, also writing it to writer if given.
+
+        Results for unchanged buckets are carried forward from previous_output,
+        e.g. the previous run's index, when running incrementally. Issues are
+        written to writer as they're found, so in the order probes finish, and
+        without help texts.
+        """
         start = datetime.utcnow()
-        failures = list(self._get_issues())
+        if self._checkpoint:
+            if self._checkpoint.load(start):
+                start = cast(datetime, self._checkpoint.start_time)
+            else:
+                self._checkpoint.start_time = start
+        tests = [test.__name__ for test in self.test_classes]
+        if writer:
+            writer.write("run", start_time=start, tests=tests)
+        self._writer = writer
+        if previous_output:
+            oldest = start - self._max_age if self._max_age else None
+            self._previous_run = PreviousRun(previous_output, oldest)
+        with metrics.timer("phase.probing"):
+            failures = self._get_issues()
+        metrics.increment("issues", len(failures))
+        if self._streamed:
+            accounts = [account_from_key(key) for key in sorted(self.config_keys)]
+            extra.setdefault("accounts", accounts)
+            owners = {name: sorted(owners) for name, owners in self._owners.items()}
+            extra.setdefault("owners", dict(sorted(owners.items())))
         end = datetime.utcnow()
         output = {
             "start_time": start,
             "end_time": end,
-            "tests": [test.__name__ for test in self.test_classes],
+            "tests": tests,
             "issues": failures,
+            "inconclusive": self._in_output_order(self._inconclusive),
+            "skipped": self._in_output_order(self._skipped),
+            "verify_all": self._verify_all,
+            "buckets": self._bucket_states(start),
             "external_ip": get_external_ip(),
+            "metrics": metrics.snapshot(),
             **extra,
         }
+        if writer:
+            output["format"] = jsonl_output.FORMAT
+            writer.write_buckets_and_summary(output)
         return cast(Output, output)
 
-    def run_and_upload(self, **extra: Any) -> Output:
-        """Run the tests and upload output."""
-        output = self.run(**extra)
-        output_key = key_from_output(output)
-        log.info("Uploading to s3://%s/%s", self._bucket_name, output_key)
-        boto3.client("s3").put_object(
-            Body=dumps(output), Bucket=self._bucket_name, Key=output_key
-        )
+    def run_and_upload(
+        self, on_output: Optional[Callable[[Output], Any]] = None, **extra: Any
+    ) -> Output:
+        """Run the tests and upload output.
+
+        on_output is called with the output before it's uploaded, e.g. to start
+        notifying about it while the upload goes.
+        """
+        with metrics.timer("phase.previous_output_fetch"):
+            previous_output = self._previous_index_s3()
+            if previous_output is None:  # Older runs have no index
+                previous_output = self._previous_output_s3()
+        if self._output_format != jsonl_output.FORMAT:
+            output = self.run(previous_output, **extra)
+            if on_output:
+                on_output(output)
+            upload_output(self._bucket_name, output)
+            self._finish_checkpoint()
+            return output
+        with tempfile.TemporaryFile() as body:  # Lambda has disk to spare in /tmp
+            with OutputWriter(body) as writer:
+                output = self.run(previous_output, writer, **extra)
+            if on_output:
+                on_output(output)
+            body.seek(0)
+            upload_output(self._bucket_name, output, body)
+        self._finish_checkpoint()
         return output
 
-    def _previous_output_s3(
+    def _finish_checkpoint(self) -> None:
+        """Forget the checkpoint once the output is uploaded, unless the deadline
+        left probes for the next invocation to resume with."""
+        if not self._checkpoint:
+            return
+        with metrics.timer("phase.checkpoint"):
+            if any(entry["reason"] == DEADLINE for _, entry in self._skipped):
+                self._checkpoint.save()
+            else:
+                self._checkpoint.clear()
+
+    def _previous_output_key(
         self, ignore_key: str = "", hours_in_past_to_search: int = 200
-    ) -> Optional[Output]:
-        s3 = boto3.client("s3")
-        previous_outputs = s3.list_objects_v2(
-            Bucket=self._bucket_name,
-            StartAfter=(  # Really just want to make sure we retrieve the last run
-                datetime.utcnow() - timedelta(hours=hours_in_past_to_search)
-            ).isoformat(),
-        )["Contents"]
+    ) -> Optional[str]:
+        previous_outputs = [
+            obj
+            for obj in clients.s3_client()
+            .list_objects_v2(
+                Bucket=self._bucket_name,
+                StartAfter=(  # Really just want to make sure we retrieve the last run
+                    datetime.utcnow() - timedelta(hours=hours_in_past_to_search)
+                ).isoformat(),
+            )
+            .get("Contents", [])
+            if is_output_key(obj["Key"])
+        ]
         # Compare to previous outputs
         if previous_outputs and previous_outputs[-1]["Key"] == ignore_key:
             # Consistency of LIST after PUT is eventual so can't be guaranteed
             previous_outputs = previous_outputs[:-1]
-        if previous_outputs:
-            previous_key = previous_outputs[-1]["Key"]
-            log.warning("Comparing to s3://%s/%s", self._bucket_name, previous_key)
-            return json.load(
-                s3.get_object(Bucket=self._bucket_name, Key=previous_key)["Body"]
-            )
-        return None
+        if not previous_outputs:
+            return None
+        previous_key = previous_outputs[-1]["Key"]
+        log.warning("Comparing to s3://%s/%s", self._bucket_name, previous_key)
+        return cast(str, previous_key)
+
+    def _previous_output_s3(self, **kwargs: Any) -> Optional[Output]:
+        previous_key = self._previous_output_key(**kwargs)
+        if previous_key is None:
+            return None
+        s3 = clients.s3_client()
+        body = s3.get_object(Bucket=self._bucket_name, Key=previous_key)["Body"]
+        if previous_key.endswith(jsonl_output.SUFFIX):
+            return cast(Output, jsonl_output.read_output(body))
+        return cast(Output, json.load(body))
+
+    def _previous_issues_s3(self, **kwargs: Any) -> Optional[Set[Tuple[str, str]]]:
+        """Read just the previous run's issues from its output, streaming JSON Lines
+        outputs rather than building them up in memory."""
+        previous_key = self._previous_output_key(**kwargs)
+        if previous_key is None:
+            return None
+        s3 = clients.s3_client()
+        body = s3.get_object(Bucket=self._bucket_name, Key=previous_key)["Body"]
+        if previous_key.endswith(jsonl_output.SUFFIX):
+            issues: Iterable[Dict[str, Any]] = jsonl_output.read_issues(body)
+        else:
+            issues = json.load(body)["issues"]
+        return {(issue["issue"], issue["resource"]) for issue in issues}
+
+    def _previous_index_s3(
+        self, ignore_key: str = "", hours_in_past_to_search: int = 200
+    ) -> Optional[Output]:
+        """Read the previous run's issues and bucket states from its compact
+        index, if there is one."""
+        s3 = clients.s3_client()
+        response = clients.get_or_none(
+            s3.get_object, Bucket=self._bucket_name, Key=LATEST_KEY
+        )
+        latest = response and json.load(response["Body"])
+        if latest and latest["output_key"] == ignore_key:
+            latest = latest["previous"]
+        oldest_key = (
+            datetime.utcnow() - timedelta(hours=hours_in_past_to_search)
+        ).isoformat()
+        if not latest or latest["output_key"] < oldest_key:
+            return None
+        log.warning("Comparing to s3://%s/%s", self._bucket_name, latest["index_key"])
+        index = s3.get_object(Bucket=self._bucket_name, Key=latest["index_key"])
+        previous = json.loads(gzip.decompress(index["Body"].read()))
+        if isinstance(previous, list):  # Older runs only indexed (issue, bucket) pairs
+            return None
+        return cast(Output, previous)
 
     def diff_previous_s3(
         self,
@@ -97,14 +574,27 @@ class TestRunner:
         hours_in_past_to_search: int = 200,
     ) -> Tuple[Set[Tuple[str, str]], Set[Tuple[str, str]]]:
         """Return the new issues and the fixed issues compared to the previous run."""
-        latest_output_key = key_from_output(latest_output)
-        previous_output = self._previous_output_s3(
-            ignore_key=latest_output_key,
-            hours_in_past_to_search=hours_in_past_to_search,
+        search: Dict[str, Any] = {
+            "ignore_key": key_from_output(latest_output),
+            "hours_in_past_to_search": hours_in_past_to_search,
+        }
+        index = self._previous_index_s3(**search)
+        previous_issues = (
+            set_of_issues(index, None)
+            if index is not None
+            else self._previous_issues_s3(**search)  # Older runs have no index
+        )
+        if previous_issues is None:
+            return set_of_issues(latest_output, whitelist), set()
+        return diff_issues(
+            set_of_issues(latest_output, whitelist),
+            (
+                whitelist.filter(previous_issues, bucket_owners(latest_output))
+                if whitelist
+                else previous_issues
+            ),
+            unverified_issues(latest_output),
         )
-        if previous_output:
-            return diff_previous(latest_output, previous_output, whitelist)
-        return set_of_issues(latest_output, whitelist), set()
 
 
 def diff_previous(
@@ -113,10 +603,25 @@ def diff_previous(
     whitelist: Optional[Whitelist] = None,
 ) -> Tuple[Set[Tuple[str, str]], Set[Tuple[str, str]]]:
     """Return the new issues and the fixed issues compared to the previous output."""
-    current_issues = set_of_issues(latest_output, whitelist)
-    previous_issues = set_of_issues(previous_output, whitelist)
+    return diff_issues(
+        set_of_issues(latest_output, whitelist),
+        set_of_issues(previous_output, whitelist),
+        unverified_issues(latest_output),
+    )
+
+
+def diff_issues(
+    current_issues: Set[Tuple[str, str]],
+    previous_issues: Set[Tuple[str, str]],
+    unverified: Optional[Set[Tuple[str, str]]] = None,
+) -> Tuple[Set[Tuple[str, str]], Set[Tuple[str, str]]]:
+    """Return the new issues and the fixed issues.
+
+    Issues in unverified weren't necessarily fixed, so they aren't reported
+    as such.
+    """
     new_issues = current_issues - previous_issues
-    resolved_issues = previous_issues - current_issues
+    resolved_issues = previous_issues - current_issues - (unverified or set())
     if new_issues:
         log.error("%d new issues: %s", len(new_issues), new_issues)
     if resolved_issues:
@@ -124,33 +629,61 @@ def diff_previous(
     return new_issues, resolved_issues
 
 
+def unverified_issues(output: Output) -> Set[Tuple[str, str]]:
+    """(Issue, bucket) pairs whose probe was inconclusive, or skipped for a
+    reason which doesn't rule out the issue, e.g. because it's whitelisted
+    there. The bucket's other issues were still verified."""
+    issue_of_test = {
+        test.__name__: test.issue_class.__name__ for test in TestRunner.test_classes
+    }
+    entries = output.get("inconclusive", []) + [
+        entry
+        for entry in output.get("skipped", [])
+        if entry["reason"] in UNVERIFIED_REASONS
+    ]
+    return {
+        (issue_of_test[entry["test"]], entry["resource"])
+        for entry in entries
+        if entry["test"] in issue_of_test
+    }
+
+
 def parse_whitelist(whitelist_json: Dict[str, List[str]]) -> Whitelist:
-    return cast(
-        Whitelist,
-        {
-            (issue, bucket_name)
-            for issue, buckets in whitelist_json.items()
-            for bucket_name in buckets
-        },
-    )
+    return Whitelist(whitelist_json)
+
+
+# Compiled whitelist per config bucket with its ETag, kept while Lambda reuses
+# the container so an unchanged whitelist is neither downloaded nor compiled again
+_whitelist_cache: Dict[str, Tuple[str, Whitelist]] = {}
 
 
 def get_whitelist(config_bucket_name: str) -> Optional[Whitelist]:
     """Fetch whitelist.json, parse it and return it if it exists."""
+    cached = _whitelist_cache.get(config_bucket_name)
+    conditions = {"IfNoneMatch": cached[0]} if cached else {}
     try:
-        whitelist_json = json.load(
-            boto3.client("s3").get_object(
-                Bucket=config_bucket_name, Key="whitelist.json"
-            )["Body"]
+        response = clients.s3_client().get_object(
+            Bucket=config_bucket_name, Key="whitelist.json", **conditions
         )
-        return parse_whitelist(whitelist_json)
     except ClientError as e:
-        if e.response["Error"]["Code"] == "NoSuchKey":
+        code = e.response["Error"]["Code"]
+        if cached and code in ("304", "NotModified"):
+            return cached[1]
+        if code == "NoSuchKey":
+            _whitelist_cache.pop(config_bucket_name, None)
             log.warning(
                 "No whitelist found at s3://%s/whitelist.json", config_bucket_name
             )
             return None
         raise
+    whitelist = parse_whitelist(json.load(response["Body"]))
+    _whitelist_cache[config_bucket_name] = (response["ETag"], whitelist)
+    return whitelist
+
+
+def bucket_owners(output: Output) -> Dict[str, List[str]]:
+    """Accounts whose configs list each bucket, for runs which know them."""
+    return cast(Dict[str, List[str]], output.get("owners", {}))
 
 
 def set_of_issues(
@@ -159,12 +692,88 @@ def set_of_issues(
     """Processes run output JSON and returns a set of issue tuples to compare with previous runs."""
     issues = set((issue["issue"], issue["resource"]) for issue in output["issues"])
     if whitelist:
-        issues -= whitelist
+        issues = whitelist.filter(issues, bucket_owners(output))
     return issues
 
 
+def parse_time(value: Any) -> datetime:
+    """Times are datetimes in fresh output but ISO strings once loaded from S3."""
+    return value if isinstance(value, datetime) else datetime.fromisoformat(value)
+
+
 def key_from_output(output: Output) -> str:
-    return f"{output['end_time'].isoformat()}.json"
+    jsonl = output.get("format") == jsonl_output.FORMAT
+    return (
+        f"{output['end_time'].isoformat()}{jsonl_output.SUFFIX if jsonl else '.json'}"
+    )
+
+
+def is_output_key(key: str) -> bool:
+    """Run outputs are at the top level; prefixes like shards/ hold other files."""
+    return "/" not in key and key.endswith((".json", jsonl_output.SUFFIX))
+
+
+def upload_output(
+    output_bucket_name: str, output: Output, body: Optional[IO[bytes]] = None
+) -> None:
+    """Upload the output with a compact index of its issues, and point to them.
+
+    body is the output already written as JSON Lines, if it was. The pointer
+    at LATEST_KEY also keeps the previous run's entry, so the previous run
+    can be found after this one has replaced it.
+    """
+    if body is None and output.get("format") == jsonl_output.FORMAT:
+        with tempfile.TemporaryFile() as jsonl_body:
+            jsonl_output.write_output(jsonl_body, output)
+            jsonl_body.seek(0)
+            upload_output(output_bucket_name, output, jsonl_body)
+        return
+    s3 = clients.s3_client()
+    output_key = key_from_output(output)
+    index_key = f"{INDEX_PREFIX}{output_key}.gz"
+    log.info("Uploading to s3://%s/%s", output_bucket_name, output_key)
+    with metrics.timer("phase.upload"):
+        s3.put_object(
+            Body=dumps(output) if body is None else body,
+            Bucket=output_bucket_name,
+            Key=output_key,
+        )
+        index = {
+            "issues": [
+                {k: v for k, v in issue.items() if k != "help"}
+                for issue in output["issues"]
+            ],
+            "buckets": output.get("buckets", {}),
+        }
+        s3.put_object(
+            Body=gzip.compress(dumps(index).encode()),
+            Bucket=output_bucket_name,
+            Key=index_key,
+        )
+        response = clients.get_or_none(
+            s3.get_object, Bucket=output_bucket_name, Key=LATEST_KEY
+        )
+        previous = response and json.load(response["Body"])
+        if previous and previous["output_key"] == output_key:  # Uploaded again
+            previous = previous["previous"]
+        if previous:
+            previous.pop("previous", None)
+        latest = {
+            "output_key": output_key,
+            "index_key": index_key,
+            "previous": previous,
+        }
+        s3.put_object(
+            Body=json.dumps(latest), Bucket=output_bucket_name, Key=LATEST_KEY
+        )
+    with metrics.timer("phase.history"):
+        update_history(
+            s3,
+            output_bucket_name,
+            parse_time(output["start_time"]),
+            set_of_issues(output, None),
+            unverified_issues(output),
+        )
 
 
 def get_external_ip() -> str:
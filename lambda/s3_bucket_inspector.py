@@ -1,27 +1,54 @@
 import os
 import sys
 
+import json
 import logging
 import random
-from datetime import datetime
-from functools import lru_cache
-from typing import Any, Dict, Generator, List, Optional
+import threading
+from abc import ABC, abstractmethod
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+from datetime import datetime, timedelta
+from hashlib import sha256
+from itertools import islice
+from typing import (
+    Any,
+    Callable,
+    cast,
+    Dict,
+    Generator,
+    Hashable,
+    Iterable,
+    List,
+    NamedTuple,
+    Optional,
+    Tuple,
+    Type,
+)
 
 from botocore.client import BaseClient
-import requests
 
+from analysis import PUBLIC_GRANTEES
+import clients
 from issues import Issue
+from metrics import metrics
+from probe_client import get_client, ProbeError
 
 log = logging.getLogger(__name__)
+Submit = Callable[..., "Future[Any]"]  # Like Executor.submit
 
 
 def bucket_root(bucket_name: str) -> str:
+    endpoint_url = get_client().endpoint_url
+    if endpoint_url:
+        return f"{endpoint_url}/{bucket_name}"
     if "." not in bucket_name:
         return f"https://{bucket_name}.s3.amazonaws.com"
     return f"https://s3-{bucket_region(bucket_name)}.amazonaws.com/{bucket_name}"
 
 
-@lru_cache(maxsize=None)  # Don't actually care about it being LRU
+_bucket_regions: Dict[str, str] = {}
+
+
 def bucket_region(bucket_name: str) -> str:
     """Find the region of an S3 bucket.
 
@@ -29,170 +56,602 @@ def bucket_region(bucket_name: str) -> str:
     on https://b.u.c.k.e.t.s3.amazonaws.com since the wildcard certificate AWS
     returns (CN=*.s3.amazonaws.com) does not match multi-level subdomains.
     Instead of just setting verify=False, let's find the correct region.
+
+    Regions resolved by the config job are used when seeded with
+    `seed_bucket_regions`; the anonymous lookup is only a fallback.
     """
-    head = requests.head(f"https://s3.amazonaws.com/{bucket_name}")
+    if bucket_name not in _bucket_regions:
+        _bucket_regions[bucket_name] = bucket_region_lookup(bucket_name)
+    return _bucket_regions[bucket_name]
+
+
+@metrics.instrumented
+def bucket_region_lookup(bucket_name: str) -> str:
+    head = get_client().head(f"https://s3.amazonaws.com/{bucket_name}")
     region = head.headers.get("x-amz-bucket-region")
-    assert (
-        head.status_code == 301 and region
-    ), f"Cannot find region for bucket {bucket_name}"
+    if head.status_code != 301 or not region:
+        raise ProbeError(f"Cannot find region for bucket {bucket_name}")
     return region
 
 
-class PubliclyListableBucketIssue(Issue):
+def seed_bucket_regions(
+    s3_bucket_regions: Dict[str, Dict[str, str]], ttl: timedelta
+) -> None:
+    """Cache regions from a config, skipping any resolved longer than ttl ago."""
+    oldest = datetime.utcnow() - ttl
+    for bucket_name, entry in s3_bucket_regions.items():
+        if datetime.fromisoformat(entry["resolved_time"]) >= oldest:
+            _bucket_regions[bucket_name] = entry["region"]
+
+
+class BucketTest(ABC):
+    """Base for tests made of one independent anonymous probe per bucket.
+
+    Splitting a test into `buckets` and `check` lets the runner schedule every
+    (test, bucket) probe on its own instead of draining `find_issues` in turn.
+    `action` and `acl_permissions` say what the probe needs anonymous users
+    to be allowed, so that the runner can rule out probes which can't succeed.
+    `issue_class` is what it raises, which is what the whitelist matches.
+    Tests which send several requests at once say how many in
+    `requests_at_once` and send them through `check_with`'s submit, so that
+    each counts against the engine's limits.
+    """
+
+    issue_class: Type[Issue] = Issue
+    requests_at_once = 1
+    action = ""
+    acl_permissions: Optional[Tuple[str, ...]] = None  # None if object ACLs decide
+
+    def __init__(self, s3_bucket_list: List[str], **_: Any) -> None:
+        self._bucket_list = s3_bucket_list
+
     @property
-    def help(self) -> Optional[str]:
+    def buckets(self) -> List[str]:
+        return self._bucket_list
+
+    def work(self, bucket_name: str) -> List[Hashable]:
+        """What probing the bucket covers, so that a bucket in several configs
+        is only probed once."""
+        return [bucket_name]
+
+    def restrict(self, bucket_name: str, work: List[Hashable]) -> None:
+        """Only cover part of the bucket's work, the rest being covered already."""
+
+    @abstractmethod
+    def check(self, bucket_name: str) -> Optional[Issue]:
+        pass
+
+    def check_with(
+        self, bucket_name: str, _submit: Submit, _at_once: int
+    ) -> Optional[Issue]:
+        """Check the bucket, sending up to at_once requests at once through submit."""
+        return self.check(bucket_name)
+
+    def find_issues(self) -> Generator[Issue, None, None]:
+        for bucket_name in self.buckets:
+            issue = self.check(bucket_name)
+            if issue:
+                yield issue
+
+
+class PubliclyListableBucketIssue(Issue):
+    __slots__ = ()
+
+    def render_help(self) -> Optional[str]:
         return (
             "The list of keys stored within an S3 bucket should not be public, "
             f"but {bucket_root(self.resource)} lists the keys publicly."
         )
 
 
-class PubliclyListableBuckets:
+class PubliclyListableBuckets(BucketTest):
     """Raises an issue on any S3 bucket where the keys are publicly listable."""
 
-    def __init__(self, s3_bucket_list: List[str], **_: Any) -> None:
-        self._bucket_list = s3_bucket_list
+    issue_class = PubliclyListableBucketIssue
+    action = "s3:ListBucket"
+    acl_permissions = ("READ", "FULL_CONTROL")
 
-    def find_issues(self) -> Generator[Issue, None, None]:
-        for bucket_name in self._bucket_list:
-            if bucket_publicly_listable(bucket_name):
-                yield PubliclyListableBucketIssue(bucket_name)
+    def check(self, bucket_name: str) -> Optional[Issue]:
+        if bucket_publicly_listable(bucket_name):
+            return PubliclyListableBucketIssue(bucket_name)
+        return None
 
 
+@metrics.instrumented
 def bucket_publicly_listable(bucket_name: str) -> bool:
-    response = requests.get(f"{bucket_root(bucket_name)}/?max-keys=0")
+    response = get_client().get(f"{bucket_root(bucket_name)}/?max-keys=0")
     if response.status_code == 200:
-        assert response.content.endswith(
-            b"</ListBucketResult>"
-        ), f"Unexpected ListBucketResult for {bucket_name}"
+        if not response.content.endswith(b"</ListBucketResult>"):
+            raise ProbeError(f"Unexpected ListBucketResult for {bucket_name}")
         return True
-    assert (
-        response.status_code == 403
-    ), f"Unexpected status code {response.status_code} for bucket {bucket_name}"
+    if response.status_code != 403:
+        raise ProbeError(
+            f"Unexpected status code {response.status_code} for bucket {bucket_name}"
+        )
     return False
 
 
+class WriteAccess(NamedTuple):
+    uploadable: bool
+    deletable: bool
+
+
+WRITE_TEST_KEY = "s3_bucket_inspector.write.test"
+WRITE_TEST_PAYLOAD = b"s3_bucket_inspector write test\n"
+
+
+@metrics.instrumented
+def bucket_write_access(bucket_name: str) -> WriteAccess:
+    """Try an anonymous upload and then delete of the same key, back to back.
+
+    Both go over the same kept-alive connection, and the delete removes the
+    object if the upload worked. If the upload worked but the delete didn't,
+    the object is left behind, since we have no other way to remove it.
+    """
+    url = f"{bucket_root(bucket_name)}/{WRITE_TEST_KEY}"
+    uploadable = get_client().put(url, data=WRITE_TEST_PAYLOAD).status_code == 200
+    deletable = get_client().delete(url).status_code == 204
+    if uploadable and not deletable:
+        log.warning("Couldn't clean up s3://%s/%s", bucket_name, WRITE_TEST_KEY)
+    return WriteAccess(uploadable, deletable)
+
+
+class WriteProbes:
+    """Probes each bucket's write access once, for both the write tests.
+
+    Whichever test gets to a bucket first runs the probe and the other waits
+    for its result.
+    """
+
+    def __init__(self) -> None:
+        self._results: Dict[str, Future] = {}
+        self._lock = threading.Lock()
+
+    def get(self, bucket_name: str) -> WriteAccess:
+        with self._lock:
+            future = self._results.get(bucket_name)
+            first = future is None
+            if future is None:
+                future = self._results[bucket_name] = Future()
+        if first:
+            try:
+                future.set_result(bucket_write_access(bucket_name))
+            except BaseException as e:  # Never leave the other test waiting
+                future.set_exception(e)
+        return cast(WriteAccess, future.result())
+
+
+class BucketWriteTest(BucketTest, ABC):
+    """Base for the tests answered by the combined write probe."""
+
+    acl_permissions = ("WRITE", "FULL_CONTROL")
+
+    def __init__(
+        self,
+        s3_bucket_list: List[str],
+        write_probes: Optional[WriteProbes] = None,
+        **_: Any,
+    ) -> None:
+        super().__init__(s3_bucket_list)
+        self._write_probes = write_probes or WriteProbes()
+
+
 class PubliclyUploadableBucketIssue(Issue):
-    @property
-    def help(self) -> Optional[str]:
+    __slots__ = ()
+
+    def render_help(self) -> Optional[str]:
         return (
             "An S3 bucket should not allow file uploads from the Internet, "
             f"but {self.resource} allows uploads."
         )
 
 
-class PubliclyUploadableBuckets:
+class PubliclyUploadableBuckets(BucketWriteTest):
     """Raises an issue on any S3 bucket where public uploads are allowed"""
 
-    def __init__(self, s3_bucket_list: List[str], **_: Any) -> None:
-        self._bucket_list = s3_bucket_list
-
-    def find_issues(self) -> Generator[Issue, None, None]:
-        for bucket_name in self._bucket_list:
-            if bucket_publicly_uploadable(bucket_name):
-                yield PubliclyUploadableBucketIssue(bucket_name)
-
+    issue_class = PubliclyUploadableBucketIssue
+    action = "s3:PutObject"
 
-def bucket_publicly_uploadable(bucket_name: str) -> bool:
-    test_key = "s3_bucket_inspector.upload.test"
-    content: bytes = datetime.utcnow().isoformat().encode()
-    response = requests.put(
-        f"{bucket_root(bucket_name)}/{test_key}", files={"file": content}
-    )
-    return response.status_code == 200
+    def check(self, bucket_name: str) -> Optional[Issue]:
+        if self._write_probes.get(bucket_name).uploadable:
+            return PubliclyUploadableBucketIssue(bucket_name)
+        return None
 
 
 class PubliclyDeletableBucketIssue(Issue):
-    @property
-    def help(self) -> Optional[str]:
+    __slots__ = ()
+
+    def render_help(self) -> Optional[str]:
         return (
             "An S3 bucket should not allow everyone to delete files, "
             f"but {self.resource} allows deletions."
         )
 
 
-class PubliclyDeletableBuckets:
+class PubliclyDeletableBuckets(BucketWriteTest):
     """Raises an issue on any S3 bucket where public deletions are allowed."""
 
-    def __init__(self, s3_bucket_list: List[str], **_: Any) -> None:
-        self._bucket_list = s3_bucket_list
-
-    def find_issues(self) -> Generator[Issue, None, None]:
-        for bucket_name in self._bucket_list:
-            if bucket_publicly_deletable(bucket_name):
-                yield PubliclyDeletableBucketIssue(bucket_name)
+    issue_class = PubliclyDeletableBucketIssue
+    action = "s3:DeleteObject"
 
-
-def bucket_publicly_deletable(bucket_name: str) -> bool:
-    test_key = "s3_bucket_inspector.delete.test"
-    response = requests.delete(f"{bucket_root(bucket_name)}/{test_key}")
-    return response.status_code == 204
+    def check(self, bucket_name: str) -> Optional[Issue]:
+        if self._write_probes.get(bucket_name).deletable:
+            return PubliclyDeletableBucketIssue(bucket_name)
+        return None
 
 
 class PubliclyReadableFileIssue(Issue):
+    __slots__ = ("key",)
+    key: str
+
     def __init__(self, bucket_name: str, key: str):
-        self.key = key
         super().__init__(bucket_name)
+        object.__setattr__(self, "key", key)
 
-    def to_json(self) -> Dict[str, Optional[str]]:
-        return {"key": self.key, **super().to_json()}
+    def to_json(self, include_help: bool = True) -> Dict[str, Optional[str]]:
+        return {"key": self.key, **super().to_json(include_help)}
 
-    @property
-    def help(self) -> Optional[str]:
+    @classmethod
+    def from_json(cls, fields: Dict[str, Any]) -> "PubliclyReadableFileIssue":
+        return cls(fields["resource"], fields["key"])
+
+    def render_help(self) -> Optional[str]:
         return (
             "The files stored within this S3 bucket should not be public, "
             f"but {bucket_root(self.resource)}/{self.key} was readable."
         )
 
 
-class PubliclyReadableFiles:
+class PubliclyReadableFiles(BucketTest):
     """Raises an issue on any S3 bucket with publicly readable files."""
 
+    issue_class = PubliclyReadableFileIssue
+    action = "s3:GetObject"
+    requests_at_once = 4  # Keys probed at once per bucket
+
     def __init__(self, s3_random_files: Dict[str, List[str]], **_: Any) -> None:
-        self._keys_by_bucket = s3_random_files
+        self._keys_by_bucket = dict(s3_random_files)  # Restricted per bucket
+        super().__init__(list(s3_random_files))
 
-    def find_issues(self) -> Generator[Issue, None, None]:
-        for bucket_name, keys in self._keys_by_bucket.items():
-            for key in keys:
-                if file_publicly_readable(bucket_name, key):
-                    yield PubliclyReadableFileIssue(bucket_name, key)
-                    break  # Try next bucket
+    def work(self, bucket_name: str) -> List[Hashable]:
+        return [(bucket_name, key) for key in self._keys_by_bucket[bucket_name]]
+
+    def restrict(self, bucket_name: str, work: List[Hashable]) -> None:
+        self._keys_by_bucket[bucket_name] = [key for _, key in work]  # type: ignore
+
+    def check(self, bucket_name: str) -> Optional[Issue]:
+        return self._check(bucket_name, 1, run_now)
 
+    def check_with(
+        self, bucket_name: str, submit: Submit, at_once: int
+    ) -> Optional[Issue]:
+        return self._check(bucket_name, at_once, submit)
 
+    def _check(
+        self, bucket_name: str, parallel: int, submit: Submit
+    ) -> Optional[Issue]:
+        key = first_readable_key(
+            bucket_name, self._keys_by_bucket[bucket_name], parallel, submit
+        )
+        if key is not None:
+            return PubliclyReadableFileIssue(bucket_name, key)
+        return None
+
+
+@metrics.instrumented
 def file_publicly_readable(bucket_name: str, key: str) -> bool:
-    response = requests.head(f"{bucket_root(bucket_name)}/{key}")
+    response = get_client().head(f"{bucket_root(bucket_name)}/{key}")
     return response.status_code != 403
 
 
+def run_now(fn: Callable[..., Any], *args: Any) -> "Future[Any]":
+    """Submit which runs fn straight away, for probing without an engine."""
+    future: "Future[Any]" = Future()
+    try:
+        future.set_result(fn(*args))
+    except Exception as e:  # pylint: disable=broad-except
+        future.set_exception(e)
+    return future
+
+
+def first_readable_key(
+    bucket_name: str, keys: List[str], parallel: int, submit: Submit
+) -> Optional[str]:
+    """Return the first of the keys, in order, which is publicly readable.
+
+    Up to `parallel` keys are probed at once through submit. Once a key is
+    found to be readable, probes of later keys are cancelled and only earlier
+    keys are waited for, so the answer is the same as probing them one by one.
+    """
+    first_readable = len(keys)
+    next_index = 0
+    pending: Dict[Future, int] = {}
+    while True:
+        while next_index < first_readable and len(pending) < parallel:
+            future = submit(file_publicly_readable, bucket_name, keys[next_index])
+            pending[future] = next_index
+            next_index += 1
+        if not pending:
+            break
+        done, _ = wait(pending, return_when=FIRST_COMPLETED)
+        for future in done:
+            index = pending.pop(future)
+            if future.result():
+                first_readable = min(first_readable, index)
+        for future, index in list(pending.items()):
+            if index > first_readable:
+                future.cancel()  # No-op if already running, but we don't wait
+                del pending[future]
+    return keys[first_readable] if first_readable < len(keys) else None
+
+
+def issue_from_json(issue: Dict[str, Any]) -> Optional[Issue]:
+    issue_classes = {cls.__name__: cls for cls in Issue.__subclasses__()}
+    issue_class = issue_classes.get(issue["issue"])
+    return issue_class.from_json(issue) if issue_class else None
+
+
+def issue_help(issue: Dict[str, Any]) -> Optional[str]:
+    """Derive the help text of an issue read from output which doesn't store it."""
+    parsed = issue_from_json(issue)
+    return parsed.help if parsed else None
+
+
 def get_s3_bucket_list(s3_client: BaseClient, **_: Any) -> List[str]:
     """Use AWS key to list all our buckets."""
     return [bucket["Name"] for bucket in s3_client.list_buckets()["Buckets"]]
 
 
-def keys_in_bucket(s3_client: BaseClient, bucket_name: str, max_keys: int) -> List[str]:
-    log.debug("Getting %d keys from bucket '%s'", max_keys, bucket_name)
-    result = s3_client.list_objects_v2(
+def location_region(s3_client: BaseClient, bucket_name: str) -> str:
+    location = s3_client.get_bucket_location(Bucket=bucket_name)["LocationConstraint"]
+    # Buckets in us-east-1 have no location constraint and some old eu-west-1
+    # buckets still report the legacy "EU" constraint
+    return {None: "us-east-1", "EU": "eu-west-1"}.get(location, location)
+
+
+def lookup_bucket_locations(
+    s3_client: BaseClient, bucket_names: List[str], listing_workers: int = 8
+) -> Dict[str, str]:
+    """Look up the region of every bucket."""
+    with ThreadPoolExecutor(max_workers=listing_workers) as executor:
+        regions = executor.map(
+            lambda bucket_name: location_region(s3_client, bucket_name), bucket_names
+        )
+        return dict(zip(bucket_names, regions))
+
+
+def _bucket_client(
+    s3_client: BaseClient, locations: Optional[Dict[str, str]], bucket_name: str
+) -> BaseClient:
+    """Client in the bucket's region if we know it, so S3 needn't redirect us."""
+    if locations is None:
+        return s3_client
+    return clients.s3_client(locations[bucket_name])
+
+
+def get_s3_bucket_regions(
+    s3_client: BaseClient,
+    bucket_names: Optional[List[str]] = None,
+    bucket_locations: Optional[Dict[str, str]] = None,
+    **_: Any,
+) -> Dict[str, Dict[str, Any]]:
+    """Use AWS key to find the regions of buckets which need a regional endpoint."""
+    if bucket_names is None:
+        bucket_names = get_s3_bucket_list(s3_client)
+    return {
+        bucket_name: {
+            "region": (
+                bucket_locations[bucket_name]
+                if bucket_locations
+                else location_region(s3_client, bucket_name)
+            ),
+            "resolved_time": datetime.utcnow(),
+        }
+        for bucket_name in bucket_names
+        if "." in bucket_name
+    }
+
+
+def bucket_access_settings(s3_client: BaseClient, bucket_name: str) -> Dict[str, Any]:
+    """The bucket-level settings that decide what anonymous users can do.
+
+    Object ACLs aren't covered.
+    """
+    acl = s3_client.get_bucket_acl(Bucket=bucket_name)
+    policy = clients.get_or_none(
+        s3_client.get_bucket_policy, "NoSuchBucketPolicy", Bucket=bucket_name
+    )
+    public_access_block = clients.get_or_none(
+        s3_client.get_public_access_block,
+        "NoSuchPublicAccessBlockConfiguration",
+        Bucket=bucket_name,
+    )
+    ownership_controls = clients.get_or_none(
+        s3_client.get_bucket_ownership_controls,
+        "OwnershipControlsNotFoundError",
         Bucket=bucket_name,
-        MaxKeys=max_keys,  # Fetches the first max_keys files, sorted alphabetically by key
     )
-    if result["KeyCount"] == 0:
-        return []
-    return [obj["Key"] for obj in result["Contents"]]
+    return {
+        "grants": acl["Grants"],
+        "policy": policy and policy["Policy"],
+        "public_access_block": public_access_block
+        and public_access_block["PublicAccessBlockConfiguration"],
+        "object_ownership": ownership_controls
+        and ownership_controls["OwnershipControls"]["Rules"][0]["ObjectOwnership"],
+    }
 
 
-def get_s3_random_files(
+def access_settings(
     s3_client: BaseClient,
-    keys_to_return: int = 10,
-    keys_to_request: int = 100,
+    bucket_names: List[str],
+    bucket_locations: Optional[Dict[str, str]] = None,
+    listing_workers: int = 8,
+) -> Dict[str, Dict[str, Any]]:
+    """Fetch the access settings of all the buckets."""
+    with ThreadPoolExecutor(max_workers=listing_workers) as executor:
+        settings = executor.map(
+            lambda bucket_name: bucket_access_settings(
+                _bucket_client(s3_client, bucket_locations, bucket_name), bucket_name
+            ),
+            bucket_names,
+        )
+        return dict(zip(bucket_names, settings))
+
+
+def bucket_fingerprint(
+    settings: Dict[str, Any], account_block: Optional[Dict[str, bool]] = None
+) -> str:
+    """Hash a bucket's access settings, along with the account's public access block.
+
+    Object ACLs aren't covered, so a matching fingerprint doesn't prove that
+    no files have been made public since.
+    """
+    settings = {**settings, "account_public_access_block": account_block}
+    return sha256(json.dumps(settings, sort_keys=True).encode()).hexdigest()
+
+
+def get_s3_bucket_fingerprints(  # pylint: disable=too-many-arguments
+    s3_client: BaseClient,
+    bucket_names: Optional[List[str]] = None,
+    bucket_locations: Optional[Dict[str, str]] = None,
+    bucket_settings: Optional[Dict[str, Dict[str, Any]]] = None,
+    listing_workers: int = 8,
+    account_block: Optional[Dict[str, bool]] = None,
     **_: Any,
-) -> Dict[str, List[str]]:
-    """Use AWS key to list random files from our buckets."""
-    files = {
-        bucket_name: keys_in_bucket(s3_client, bucket_name, keys_to_request)
-        for bucket_name in get_s3_bucket_list(s3_client)
+) -> Dict[str, str]:
+    """Use AWS key to fingerprint the access settings of our buckets."""
+    if bucket_settings is None:
+        bucket_settings = access_settings(
+            s3_client,
+            get_s3_bucket_list(s3_client) if bucket_names is None else bucket_names,
+            bucket_locations,
+            listing_workers,
+        )
+    return {
+        bucket_name: bucket_fingerprint(settings, account_block)
+        for bucket_name, settings in bucket_settings.items()
     }
+
+
+def account_public_access_block() -> Optional[Dict[str, bool]]:
+    """The public access block of the whole account, which applies to every bucket."""
+    block = clients.get_or_none(
+        clients.client("s3control").get_public_access_block,
+        "NoSuchPublicAccessBlockConfiguration",
+        AccountId=clients.account_id(),
+    )
+    return block and block["PublicAccessBlockConfiguration"]
+
+
+def effective_public_access_block(
+    bucket_block: Optional[Dict[str, bool]], account_block: Optional[Dict[str, bool]]
+) -> Dict[str, bool]:
+    """S3 applies each setting if either the bucket or the account enables it."""
+    bucket_block, account_block = bucket_block or {}, account_block or {}
+    return {
+        setting: bool(bucket_block.get(setting) or account_block.get(setting))
+        for setting in set(bucket_block) | set(account_block)
+    }
+
+
+def get_s3_bucket_access(  # pylint: disable=too-many-arguments
+    s3_client: BaseClient,
+    bucket_names: Optional[List[str]] = None,
+    bucket_locations: Optional[Dict[str, str]] = None,
+    bucket_settings: Optional[Dict[str, Dict[str, Any]]] = None,
+    account_block: Optional[Dict[str, bool]] = None,
+    listing_workers: int = 8,
+    **_: Any,
+) -> Dict[str, Dict[str, Any]]:
+    """Use AWS key to record what decides anonymous access to our buckets.
+
+    The run lambda uses these to rule out probes which can't succeed.
+    """
+    if bucket_settings is None:
+        bucket_settings = access_settings(
+            s3_client,
+            get_s3_bucket_list(s3_client) if bucket_names is None else bucket_names,
+            bucket_locations,
+            listing_workers,
+        )
     return {
-        bucket_name: random.sample(keys, min(keys_to_return, len(keys)))
-        for bucket_name, keys in files.items()
-        if len(keys)
+        bucket_name: {
+            "public_access_block": effective_public_access_block(
+                settings["public_access_block"], account_block
+            ),
+            "object_ownership": settings["object_ownership"],
+            "public_grants": [
+                grant
+                for grant in settings["grants"]
+                if grant["Grantee"].get("URI") in PUBLIC_GRANTEES
+            ],
+            "policy": settings["policy"],
+        }
+        for bucket_name, settings in bucket_settings.items()
     }
+
+
+def keys_in_bucket(
+    s3_client: BaseClient,
+    bucket_name: str,
+    page_size: int,
+    max_pages: Optional[int] = None,
+) -> Generator[str, None, None]:
+    """Stream keys page by page, alphabetically, stopping after max_pages if set."""
+    log.debug("Listing up to %s pages of keys from bucket '%s'", max_pages, bucket_name)
+    pages = s3_client.get_paginator("list_objects_v2").paginate(
+        Bucket=bucket_name, PaginationConfig={"PageSize": page_size}
+    )
+    for page in islice(pages, max_pages):
+        for obj in page.get("Contents", []):
+            yield obj["Key"]
+
+
+def reservoir_sample(keys: Iterable[str], sample_size: int) -> List[str]:
+    """Uniformly sample from a stream of unknown length in constant memory."""
+    sample: List[str] = []
+    for seen, key in enumerate(keys):
+        if seen < sample_size:
+            sample.append(key)
+        else:
+            replace = random.randint(0, seen)
+            if replace < sample_size:
+                sample[replace] = key
+    random.shuffle(sample)  # Otherwise small buckets come back in key order
+    return sample
+
+
+def get_s3_random_files(  # pylint: disable=too-many-arguments
+    s3_client: BaseClient,
+    bucket_names: Optional[List[str]] = None,
+    bucket_locations: Optional[Dict[str, str]] = None,
+    keys_to_return: int = 10,
+    keys_to_request: int = 100,
+    pages_to_request: Optional[int] = 1,
+    listing_workers: int = 8,
+    **_: Any,
+) -> Dict[str, List[str]]:
+    """Use AWS key to list random files from our buckets.
+
+    Samples uniformly from the first pages_to_request pages of keys_to_request
+    keys, or from the whole bucket if pages_to_request is None.
+    """
+
+    def sample(bucket_name: str) -> List[str]:
+        keys = keys_in_bucket(
+            _bucket_client(s3_client, bucket_locations, bucket_name),
+            bucket_name,
+            keys_to_request,
+            pages_to_request,
+        )
+        return reservoir_sample(keys, keys_to_return)
+
+    if bucket_names is None:
+        bucket_names = get_s3_bucket_list(s3_client)
+    with ThreadPoolExecutor(max_workers=listing_workers) as executor:
+        samples = executor.map(sample, bucket_names)
+        return {
+            bucket_name: keys
+            for bucket_name, keys in zip(bucket_names, samples)
+            if len(keys)
+        }
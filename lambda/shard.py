@@ -0,0 +1,251 @@
+import json
+import logging
+import time
+from typing import Any, cast, Dict, List, Set, Union
+
+import clients
+from config import account_from_key
+from json_dumper import dumps
+from metrics import metrics
+from run import Output, parse_time, TestRunner
+
+log = logging.getLogger(__name__)
+Shard = Dict[str, Dict[str, Any]]  # Config key (e.g. 123.json) -> config
+
+
+def restrict_config(config: Dict[str, Any], bucket_names: Set[str]) -> Dict[str, Any]:
+    """Keep only the parts of a config about the given buckets.
+
+    Every per-bucket config entry is either a list of bucket names or a dict
+    keyed by bucket name, so this doesn't need to know about each generator.
+    """
+    restricted: Dict[str, Any] = {}
+    for name, value in config.items():
+        if isinstance(value, list):
+            restricted[name] = [item for item in value if item in bucket_names]
+        elif isinstance(value, dict):
+            restricted[name] = {k: v for k, v in value.items() if k in bucket_names}
+        else:
+            restricted[name] = value
+    return restricted
+
+
+def merge_work(config: Dict[str, Any], other: Dict[str, Any], bucket_name: str) -> None:
+    """Add the other config's per-bucket work on the bucket, e.g. random files,
+    to what the config has."""
+    for name, value in other.items():
+        if isinstance(value, dict) and isinstance(value.get(bucket_name), list):
+            entry = config.setdefault(name, {})
+            work = entry.get(bucket_name, [])
+            entry[bucket_name] = work + [
+                item for item in value[bucket_name] if item not in work
+            ]
+
+
+def make_shards(configs: Dict[str, Dict[str, Any]], shard_size: int) -> List[Shard]:
+    """Partition the (account, bucket) work list into shards of shard_size buckets.
+
+    A bucket listed by several configs goes to the one with the lowest key,
+    with the work of all of them, so it's probed once as in a single run.
+    """
+    listing_configs: Dict[str, List[str]] = {}
+    for config_key, config in sorted(configs.items()):
+        for bucket_name in config["s3_bucket_list"]:
+            listing_configs.setdefault(bucket_name, []).append(config_key)
+    owning_config = {
+        bucket_name: config_keys[0]
+        for bucket_name, config_keys in listing_configs.items()
+    }
+    work = [
+        (config_key, bucket_name) for bucket_name, config_key in owning_config.items()
+    ]
+    shards = []
+    for start in range(0, len(work), shard_size):
+        buckets_by_config: Dict[str, Set[str]] = {}
+        for config_key, bucket_name in work[start : start + shard_size]:
+            buckets_by_config.setdefault(config_key, set()).add(bucket_name)
+        shard: Shard = {}
+        for config_key, bucket_names in buckets_by_config.items():
+            shard[config_key] = restrict_config(configs[config_key], bucket_names)
+            for bucket_name in bucket_names:
+                for other_key in listing_configs[bucket_name][1:]:
+                    merge_work(shard[config_key], configs[other_key], bucket_name)
+        shards.append(shard)
+    return shards
+
+
+def run_shard(shard: Shard, output_bucket_name: str, **runner_options: Any) -> Output:
+    # Streamed so that the runner knows each bucket's account
+    runner = TestRunner(
+        output_bucket_name, config_stream=iter(shard.items()), **runner_options
+    )
+    return runner.run()
+
+
+def merge_outputs(partials: List[Output], **extra: Any) -> Output:
+    """Merge shard outputs, in shard order, into the output of a single run.
+
+    Issues are ordered by test and then by shard, which is the order a single
+    TestRunner over all the configs would report them in.
+    """
+    tests: List[str] = partials[0]["tests"]
+    issues, inconclusive, skipped = (
+        [
+            result
+            for test in tests
+            for partial in partials
+            for result in partial.get(results, [])
+            if result["test"] == test
+        ]
+        for results in ("issues", "inconclusive", "skipped")
+    )
+    buckets: Dict[str, Any] = {}
+    for partial in partials:
+        buckets.update(partial.get("buckets", {}))
+    output = {
+        "start_time": min(parse_time(partial["start_time"]) for partial in partials),
+        "end_time": max(parse_time(partial["end_time"]) for partial in partials),
+        "tests": tests,
+        "issues": issues,
+        "inconclusive": inconclusive,
+        "skipped": skipped,
+        "verify_all": partials[0].get("verify_all", False),
+        "buckets": buckets,
+        "external_ip": ", ".join(
+            sorted({partial["external_ip"] for partial in partials})
+        ),
+        "shards": len(partials),
+        **extra,
+    }
+    return cast(Output, output)
+
+
+def merge_metrics(snapshots: List[Dict[str, Any]]) -> Dict[str, Any]:
+    counters: Dict[str, int] = {}
+    histograms: Dict[str, Dict[str, Any]] = {}
+    for snapshot in snapshots:
+        for name, count in snapshot.get("counters", {}).items():
+            counters[name] = counters.get(name, 0) + count
+        for name, histogram in snapshot.get("histograms", {}).items():
+            merged = histograms.setdefault(
+                name, {"count": 0, "sum": 0.0, "max": 0.0, "buckets": {}}
+            )
+            merged["count"] += histogram["count"]
+            merged["sum"] += histogram["sum"]
+            merged["max"] = max(merged["max"], histogram["max"])
+            for bound, count in histogram["buckets"].items():
+                merged["buckets"][bound] = merged["buckets"].get(bound, 0) + count
+    return {"counters": counters, "histograms": histograms}
+
+
+class LocalExecutor:
+    """Runs each shard in this process, for tests and local runs."""
+
+    def __init__(self, output_bucket_name: str, **runner_options: Any) -> None:
+        self._bucket_name = output_bucket_name
+        self._runner_options = runner_options
+
+    def map(self, shards: List[Shard], run_id: str) -> List[Output]:
+        log.info("Running %d shards of run %s locally", len(shards), run_id)
+        return [
+            run_shard(shard, self._bucket_name, **self._runner_options)
+            for shard in shards
+        ]
+
+    @staticmethod
+    def merged_metrics(_: List[Output]) -> Dict[str, Any]:
+        return metrics.snapshot()  # Shards ran in this process so it has them all
+
+
+class LambdaExecutor:
+    """Invokes a worker Lambda per shard and collects their partial outputs.
+
+    Shards and partial outputs go through the output bucket, since async
+    invocation payloads are limited to 256KB. Workers call `run_worker`.
+    """
+
+    def __init__(
+        self,
+        output_bucket_name: str,
+        function_name: str,
+        timeout: float = 780,
+        poll_interval: float = 5,
+    ) -> None:
+        self._bucket_name = output_bucket_name
+        self._function_name = function_name
+        self._timeout = timeout
+        self._poll_interval = poll_interval
+
+    def map(self, shards: List[Shard], run_id: str) -> List[Output]:
+        s3 = clients.s3_client()
+        lambda_client = clients.client("lambda")
+        for index, shard in enumerate(shards):
+            shard_key = f"shards/{run_id}/{index}.json"
+            s3.put_object(Body=dumps(shard), Bucket=self._bucket_name, Key=shard_key)
+            lambda_client.invoke(
+                FunctionName=self._function_name,
+                InvocationType="Event",
+                Payload=json.dumps({"shard_key": shard_key}),
+            )
+        log.info("Invoked %s for %d shards", self._function_name, len(shards))
+        partial_keys = [
+            f"partials/{run_id}/{index}.json" for index in range(len(shards))
+        ]
+        self._wait_for(s3, f"partials/{run_id}/", len(partial_keys))
+        return [
+            json.load(s3.get_object(Bucket=self._bucket_name, Key=key)["Body"])
+            for key in partial_keys
+        ]
+
+    @staticmethod
+    def merged_metrics(partials: List[Output]) -> Dict[str, Any]:
+        return merge_metrics(
+            [metrics.snapshot()] + [partial["metrics"] for partial in partials]
+        )
+
+    def _wait_for(self, s3: Any, prefix: str, count: int) -> None:
+        deadline = time.monotonic() + self._timeout
+        while True:
+            done = s3.list_objects_v2(Bucket=self._bucket_name, Prefix=prefix)[
+                "KeyCount"
+            ]
+            if done >= count:
+                return
+            if time.monotonic() > deadline:
+                raise TimeoutError(f"Only {done} of {count} shards finished")
+            time.sleep(self._poll_interval)
+
+
+def run_worker(output_bucket_name: str, shard_key: str, **runner_options: Any) -> str:
+    """Run the shard stored at shard_key and store its partial output."""
+    s3 = clients.s3_client()
+    shard = json.load(s3.get_object(Bucket=output_bucket_name, Key=shard_key)["Body"])
+    output = run_shard(shard, output_bucket_name, **runner_options)
+    partial_key = shard_key.replace("shards/", "partials/", 1)
+    log.info("Uploading to s3://%s/%s", output_bucket_name, partial_key)
+    s3.put_object(Body=dumps(output), Bucket=output_bucket_name, Key=partial_key)
+    return partial_key
+
+
+def run_sharded(
+    configs: Dict[str, Dict[str, Any]],
+    executor: Union[LocalExecutor, LambdaExecutor],
+    shard_size: int,
+    **extra: Any,
+) -> Output:
+    """Fan the configs out over the executor in shards and merge the results.
+
+    Shards only see the config each bucket is probed with, so which accounts
+    own each bucket comes from all the configs here.
+    """
+    run_id = time.strftime("%Y-%m-%dT%H:%M:%S", time.gmtime())
+    shards = make_shards(configs, shard_size)
+    partials = executor.map(shards, run_id)
+    owners: Dict[str, List[str]] = {}
+    for config_key, config in sorted(configs.items()):
+        for bucket_name in sorted(config["s3_bucket_list"]):
+            accounts = owners.setdefault(bucket_name, [])
+            if account_from_key(config_key) not in accounts:
+                accounts.append(account_from_key(config_key))
+    extra.setdefault("owners", owners)
+    return merge_outputs(partials, metrics=executor.merged_metrics(partials), **extra)
@@ -3,13 +3,21 @@ import sys
 
 import json
 import logging
+import time
 from base64 import b64decode
-from typing import Any, Dict, List, NamedTuple, Set, Tuple
+from functools import lru_cache
+from typing import Any, Dict, List, Mapping, NamedTuple, Optional, Sequence, Set, Tuple
 
-import boto3
 import requests
 
+import clients
+
 log = logging.getLogger(__name__)
+MAX_ATTACHMENT_CHARS = 3000  # Slack truncates longer attachment text
+ATTACHMENTS_PER_MESSAGE = 10
+MAX_ATTEMPTS = 5
+MIN_INTERVAL = 1.0  # Seconds between messages; webhooks allow about one a second
+_session = requests.Session()  # Reuses the connection to Slack across messages
 
 
 class IssueGroup(NamedTuple):
@@ -37,13 +45,59 @@ def build_message(
     return message_body
 
 
+def split_group(
+    group: IssueGroup, owners: Optional[Mapping[str, Sequence[str]]] = None
+) -> List[IssueGroup]:
+    """Split a group by account, if the accounts owning each bucket are known,
+    else by issue type, and split each of those into chunks of text Slack won't
+    truncate. A bucket shared by several accounts is listed under each."""
+    by_key: Dict[str, List[Tuple[str, str]]] = {}
+    for issue, resource in sorted(group.issues):
+        for key in (owners or {}).get(resource) or [issue]:
+            by_key.setdefault(key, []).append((issue, resource))
+    chunks = []
+    for key, issues in sorted(by_key.items()):
+        key_chunks: List[Set[Tuple[str, str]]] = [set()]
+        size = 0
+        for issue, resource in issues:
+            line = len(resource) + len(issue) + 3  # Separator and newline
+            if size + line > MAX_ATTACHMENT_CHARS and key_chunks[-1]:
+                key_chunks.append(set())
+                size = 0
+            key_chunks[-1].add((issue, resource))
+            size += line
+        for index, chunk in enumerate(key_chunks, 1):
+            part = f" ({index}/{len(key_chunks)})" if len(key_chunks) > 1 else ""
+            chunks.append(IssueGroup(group.color, f"{group.title}: {key}{part}", chunk))
+    return chunks
+
+
+def build_messages(
+    issue_groups: List[IssueGroup],
+    output_bucket_name: str,
+    output_key: str,
+    owners: Optional[Mapping[str, Sequence[str]]] = None,
+) -> List[Dict[str, Any]]:
+    """Messages with the issues in size-bounded attachments, per account or type."""
+    chunks = [chunk for group in issue_groups for chunk in split_group(group, owners)]
+    return [
+        build_message(
+            chunks[start : start + ATTACHMENTS_PER_MESSAGE],
+            output_bucket_name,
+            output_key,
+        )
+        for start in range(0, len(chunks), ATTACHMENTS_PER_MESSAGE)
+    ]
+
+
 def send_diff_message(
     new_issues: Set[Tuple[str, str]],
     fixed_issues: Set[Tuple[str, str]],
     output_bucket_name: str,
     output_key: str,
+    owners: Optional[Mapping[str, Sequence[str]]] = None,
 ) -> None:
-    """Send slack message listing new and fixed issues if there are any."""
+    """Send slack messages listing new and fixed issues if there are any."""
     issue_groups = []
     if new_issues:
         issue_groups.append(
@@ -60,35 +114,63 @@ def send_diff_message(
             )
         )
     if issue_groups:
-        message = build_message(issue_groups, output_bucket_name, output_key)
-        send(message)
+        send_all(build_messages(issue_groups, output_bucket_name, output_key, owners))
 
 
 def send_full_message(
-    issues: Set[Tuple[str, str]], output_bucket_name: str, output_key: str
+    issues: Set[Tuple[str, str]],
+    output_bucket_name: str,
+    output_key: str,
+    owners: Optional[Mapping[str, Sequence[str]]] = None,
 ) -> None:
-    """Send slack message listing all issues if there are any."""
+    """Send slack messages listing all issues if there are any."""
     if issues:
-        message = build_message(
-            [IssueGroup("danger", f"{len(issues)} bucket security issues", issues)],
-            output_bucket_name,
-            output_key,
+        send_all(
+            build_messages(
+                [IssueGroup("danger", f"{len(issues)} bucket security issues", issues)],
+                output_bucket_name,
+                output_key,
+                owners,
+            )
         )
-        send(message)
 
 
-def send(message: Dict[str, Any]) -> None:
+@lru_cache(maxsize=None)
+def decrypt(ciphertext: str) -> str:
+    """Decrypt the hook once per container rather than on every message."""
+    return (
+        clients.client("kms")
+        .decrypt(CiphertextBlob=b64decode(ciphertext))["Plaintext"]
+        .decode("utf-8")
+    )
+
+
+def hook_url() -> Optional[str]:
     if "ENCRYPTED_HOOK_URL" in os.environ:
-        hook = (
-            boto3.client("kms")
-            .decrypt(CiphertextBlob=b64decode(os.environ["ENCRYPTED_HOOK_URL"]))[
-                "Plaintext"
-            ]
-            .decode("utf-8")
-        )
-    elif "HOOK_URL" in os.environ:
-        hook = os.environ["HOOK_URL"]
-    else:
+        return decrypt(os.environ["ENCRYPTED_HOOK_URL"])
+    return os.environ.get("HOOK_URL")
+
+
+def post(hook: str, message: Dict[str, Any]) -> None:
+    """Post a message, waiting out Slack's rate limit as often as it asks."""
+    for attempt in range(MAX_ATTEMPTS):
+        response = _session.post(hook, data=json.dumps(message), timeout=10)
+        if response.status_code != 429 or attempt == MAX_ATTEMPTS - 1:
+            break
+        retry_after = float(response.headers.get("Retry-After", MIN_INTERVAL))
+        log.warning("Slack rate limited us, retrying in %ss", retry_after)
+        time.sleep(retry_after)
+    response.raise_for_status()
+
+
+def send_all(messages: List[Dict[str, Any]]) -> None:
+    """Send messages in order, at most one a MIN_INTERVAL as Slack allows."""
+    hook = hook_url()
+    if not hook:
         log.warning("No Slack hook configured")
         return
-    requests.post(hook, data=json.dumps(message)).raise_for_status()
+    for index, message in enumerate(messages):
+        if index:
+            time.sleep(MIN_INTERVAL)
+        post(hook, message)
+    log.info("Sent %d Slack messages", len(messages))
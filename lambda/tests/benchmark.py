@@ -0,0 +1,150 @@
+"""Benchmark TestRunner.run against a local fake S3.
+
+Run from the lambda directory, e.g.
+    PYTHONPATH=. python tests/benchmark.py --sizes 100 1000 --latency 0.02
+Save the results with --save-baseline and compare later runs with --baseline;
+the exit code is 1 if any size regressed by more than --tolerance.
+"""
+
+import argparse
+import json
+import random
+import resource
+import sys
+import threading
+import time
+from typing import Any, Dict, List, Optional
+
+import engine
+import probe_client
+import run
+from fake_s3 import FakeS3
+
+Result = Dict[str, float]
+
+
+class TimedProbeEngine(engine.ProbeEngine):
+    """Records how long each probe takes, including waiting for a slot."""
+
+    durations: List[float] = []
+    _lock = threading.Lock()
+
+    def _check(self, probe: engine.Probe, submit: Any) -> Any:
+        start = time.perf_counter()
+        try:
+            return super()._check(probe, submit)
+        finally:
+            with self._lock:
+                self.durations.append(time.perf_counter() - start)
+
+
+def make_configs(
+    fake: FakeS3, buckets: int, accounts: int, public_fraction: float
+) -> List[Dict[str, Any]]:
+    configs: List[Dict[str, Any]] = [
+        {"s3_bucket_list": [], "s3_random_files": {}} for _ in range(accounts)
+    ]
+    for i in range(buckets):
+        bucket_name = f"bench-bucket-{i}"
+        config = configs[i % accounts]
+        config["s3_bucket_list"].append(bucket_name)
+        config["s3_random_files"][bucket_name] = [f"key-{k}" for k in range(10)]
+        if random.random() < public_fraction:
+            random.choice(
+                [fake.listable, fake.uploadable, fake.deletable, fake.readable]
+            ).add(bucket_name if random.random() < 0.75 else f"{bucket_name}/key-3")
+    return configs
+
+
+def percentile(values: List[float], fraction: float) -> float:
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+
+def bench(args: argparse.Namespace, buckets: int) -> Result:
+    with FakeS3(latency=args.latency, error_rate=args.error_rate) as fake:
+        probe_client.set_client(
+            probe_client.ProbeClient(
+                pool_maxsize=args.max_per_endpoint,
+                endpoint_url=fake.url,
+            )
+        )
+        configs = make_configs(fake, buckets, args.accounts, args.public_fraction)
+        TimedProbeEngine.durations = []
+        runner = run.TestRunner(
+            "benchmark",
+            *configs,
+            max_workers=args.max_workers,
+            max_per_endpoint=args.max_per_endpoint,
+        )
+        start = time.perf_counter()
+        output = runner.run()
+        elapsed = time.perf_counter() - start
+    durations = TimedProbeEngine.durations
+    return {
+        "buckets": buckets,
+        "probes": len(durations),
+        "issues": len(output["issues"]),
+        "requests": fake.requests,
+        "seconds": elapsed,
+        "probes_per_second": len(durations) / elapsed,
+        "p50_probe_seconds": percentile(durations, 0.5),
+        "p99_probe_seconds": percentile(durations, 0.99),
+        # Peak for the whole process (fake S3 included) so run sizes in ascending order
+        "peak_memory_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 2**10,
+    }
+
+
+def regressions(result: Result, baseline: Result, tolerance: float) -> List[str]:
+    found = []
+    if result["probes_per_second"] < baseline["probes_per_second"] * (1 - tolerance):
+        found.append("probes_per_second")
+    for metric in ("p50_probe_seconds", "p99_probe_seconds", "peak_memory_mb"):
+        if result[metric] > baseline[metric] * (1 + tolerance):
+            found.append(metric)
+    return found
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--sizes", type=int, nargs="+", default=[100, 1000, 10000])
+    parser.add_argument("--accounts", type=int, default=10)
+    parser.add_argument("--latency", type=float, default=0.01, help="seconds")
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    parser.add_argument("--public-fraction", type=float, default=0.01)
+    parser.add_argument("--max-workers", type=int, default=16)
+    # Every fake bucket shares one host, unlike real virtual-hosted buckets
+    parser.add_argument("--max-per-endpoint", type=int, default=16)
+    parser.add_argument("--baseline", help="JSON file of results to compare with")
+    parser.add_argument("--save-baseline", help="JSON file to save the results to")
+    parser.add_argument("--tolerance", type=float, default=0.2)
+    args = parser.parse_args(argv)
+
+    run.get_external_ip = lambda: "127.0.0.1"
+    run.ProbeEngine = TimedProbeEngine  # type: ignore
+    random.seed(0)
+    results = {str(size): bench(args, size) for size in args.sizes}
+    print(json.dumps(results, indent=2, sort_keys=True))
+
+    if args.save_baseline:
+        with open(args.save_baseline, "w") as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        failed = False
+        for size, result in results.items():
+            if size not in baseline:
+                continue
+            regressed = regressions(result, baseline[size], args.tolerance)
+            if regressed:
+                failed = True
+                print(
+                    f"{size} buckets regressed: {', '.join(regressed)}", file=sys.stderr
+                )
+        return 1 if failed else 0
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,190 @@
+"""A local stand-in for anonymous S3 access, for tests and benchmarks."""
+
+import hashlib
+import random
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from io import BytesIO
+from typing import Any, Dict, IO, Iterator, List, Optional, Set, Union
+from urllib.parse import urlparse
+
+from botocore.exceptions import ClientError
+
+
+class FakeS3:
+    """Serves path-style requests (http://host:port/<bucket>/<key>).
+
+    Buckets are private unless added to one of the public sets. Point the
+    probes at it with `ProbeClient(endpoint_url=fake_s3.url)`. Every request
+    is delayed by `latency` seconds and fails with a 503 SlowDown with
+    probability `error_rate`.
+    """
+
+    def __init__(self, latency: float = 0.0, error_rate: float = 0.0) -> None:
+        self.latency = latency
+        self.error_rate = error_rate
+        self.listable: Set[str] = set()
+        self.uploadable: Set[str] = set()
+        self.deletable: Set[str] = set()
+        self.readable: Set[str] = set()  # "<bucket>/<key>"
+        self.slow_downs: Dict[str, int] = {}  # bucket -> number of 503s to send first
+        self.connections = 0
+        self.requests = 0
+        self._lock = threading.Lock()
+        ThreadingHTTPServer.request_queue_size = 128
+        self._server = ThreadingHTTPServer(("127.0.0.1", 0), _handler(self))
+        self._server.daemon_threads = True
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+
+    @property
+    def url(self) -> str:
+        host, port = self._server.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def __enter__(self) -> "FakeS3":
+        self._thread.start()
+        return self
+
+    def __exit__(self, *_: object) -> None:
+        self._server.shutdown()
+        self._server.server_close()
+
+    def respond(self, method: str, path: str) -> int:
+        bucket, _, key = urlparse(path).path.lstrip("/").partition("/")
+        if self.latency:
+            time.sleep(self.latency)
+        with self._lock:
+            self.requests += 1
+            if self.slow_downs.get(bucket):
+                self.slow_downs[bucket] -= 1
+                return 503
+        if self.error_rate and random.random() < self.error_rate:
+            return 503
+        if method == "GET":
+            return 200 if bucket in self.listable else 403
+        if method == "PUT":
+            return 200 if bucket in self.uploadable else 403
+        if method == "DELETE":
+            return 204 if bucket in self.deletable else 403
+        return 200 if f"{bucket}/{key}" in self.readable else 403
+
+
+def _handler(fake: FakeS3) -> type:
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"  # Keep-alive
+
+        def setup(self) -> None:
+            super().setup()
+            with fake._lock:  # pylint: disable=protected-access
+                fake.connections += 1
+
+        def _reply(self) -> None:
+            length = int(self.headers.get("Content-Length") or 0)
+            self.rfile.read(length)
+            status = fake.respond(self.command, self.path)
+            body = b""
+            if self.command == "GET" and status == 200:
+                body = b"<ListBucketResult></ListBucketResult>"
+            self.send_response(status)
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            if self.command != "HEAD":
+                self.wfile.write(body)
+
+        do_GET = do_PUT = do_DELETE = do_HEAD = _reply
+
+        def log_message(self, *_: object) -> None:  # pylint: disable=arguments-differ
+            pass
+
+    return Handler
+
+
+class FakeS3Client:
+    """In-memory stand-in for the parts of the authenticated boto3 S3 client we use."""
+
+    def __init__(self, page_size: int = 1000) -> None:
+        self.objects: Dict[str, Dict[str, bytes]] = {}
+        self.calls: List[str] = []
+        self.page_size = page_size
+        self.locations: Dict[str, Optional[str]] = {}  # Bucket -> LocationConstraint
+
+    def put_object(
+        self, Body: Union[str, bytes, IO[bytes]], Bucket: str, Key: str, **_: Any
+    ) -> None:
+        self.calls.append("put_object")
+        if isinstance(Body, str):
+            body = Body.encode()
+        elif isinstance(Body, bytes):
+            body = Body
+        else:
+            body = Body.read()
+        self.objects.setdefault(Bucket, {})[Key] = body
+
+    def delete_object(self, Bucket: str, Key: str) -> None:
+        self.calls.append("delete_object")
+        self.objects.get(Bucket, {}).pop(Key, None)
+
+    def get_object(
+        self, Bucket: str, Key: str, IfNoneMatch: str = "", **_: Any
+    ) -> Dict[str, Any]:
+        self.calls.append("get_object")
+        try:
+            body = self.objects[Bucket][Key]
+        except KeyError:
+            raise ClientError({"Error": {"Code": "NoSuchKey"}}, "GetObject") from None
+        etag = f'"{hashlib.md5(body).hexdigest()}"'
+        if IfNoneMatch == etag:
+            raise ClientError({"Error": {"Code": "304"}}, "GetObject")
+        return {"Body": BytesIO(body), "ETag": etag}
+
+    def list_buckets(self) -> Dict[str, Any]:
+        self.calls.append("list_buckets")
+        return {"Buckets": [{"Name": name} for name in sorted(self.objects)]}
+
+    def get_bucket_location(self, Bucket: str) -> Dict[str, Any]:
+        self.calls.append("get_bucket_location")
+        return {"LocationConstraint": self.locations.get(Bucket)}
+
+    def get_bucket_acl(self, Bucket: str) -> Dict[str, Any]:
+        self.calls.append("get_bucket_acl")
+        return {"Grants": []}
+
+    def get_bucket_policy(self, Bucket: str) -> Dict[str, Any]:
+        self.calls.append("get_bucket_policy")
+        raise ClientError({"Error": {"Code": "NoSuchBucketPolicy"}}, "GetBucketPolicy")
+
+    def get_public_access_block(self, **_: Any) -> Dict[str, Any]:
+        self.calls.append("get_public_access_block")
+        raise ClientError(
+            {"Error": {"Code": "NoSuchPublicAccessBlockConfiguration"}},
+            "GetPublicAccessBlock",
+        )
+
+    def get_bucket_ownership_controls(self, Bucket: str) -> Dict[str, Any]:
+        self.calls.append("get_bucket_ownership_controls")
+        return {"OwnershipControls": {"Rules": [{"ObjectOwnership": "ObjectWriter"}]}}
+
+    def get_caller_identity(self) -> Dict[str, Any]:  # STS, for convenience
+        return {"Account": "123456789012"}
+
+    def list_objects_v2(
+        self, Bucket: str, StartAfter: str = "", Prefix: str = "", **_: Any
+    ) -> Dict[str, Any]:
+        self.calls.append("list_objects_v2")
+        keys = sorted(
+            key
+            for key in self.objects.get(Bucket, {})
+            if key > StartAfter and key.startswith(Prefix)
+        )
+        return {"KeyCount": len(keys), "Contents": [{"Key": key} for key in keys]}
+
+    def get_paginator(self, _: str) -> "FakeS3Client":
+        return self
+
+    def paginate(self, Bucket: str, **_: Any) -> Iterator[Dict[str, Any]]:
+        keys = sorted(self.objects.get(Bucket, {}))
+        for start in range(0, len(keys), self.page_size):
+            self.calls.append("list_objects_v2")
+            page = keys[start : start + self.page_size]
+            yield {"KeyCount": len(page), "Contents": [{"Key": key} for key in page]}
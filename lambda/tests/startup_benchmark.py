@@ -0,0 +1,106 @@
+"""Benchmark the Lambda handlers' cold starts against fakes of S3.
+
+Run from the lambda directory, e.g.
+    PYTHONPATH=.:tests python tests/startup_benchmark.py --repeats 5
+Each repeat of each handler runs in a fresh interpreter, as a cold start does.
+It reports how long importing the handler module takes, then the modules the
+handler imports on first use, then its first and second (warm) invocations.
+Medians across repeats are printed as JSON.
+"""
+
+import argparse
+import functools
+import json
+import os
+import statistics
+import subprocess
+import sys
+from typing import Any, Dict, List, Optional
+
+import probe_client
+from json_dumper import dumps
+
+# Modules each handler imports on first use, timed apart from its invocation
+HANDLER_MODULES = {
+    "config_handler": ["config"],
+    "run_handler": ["config", "run", "shard", "slack"],
+}
+
+COLD_START = """
+import importlib, json, sys, time
+start = time.perf_counter()
+handlers = importlib.import_module("lambda")
+imported = time.perf_counter()
+for module in {modules!r}:
+    importlib.import_module(module)
+handler_imported = time.perf_counter()
+modules = len(sys.modules)
+
+import clients, run, startup_benchmark
+from fake_s3 import FakeS3, FakeS3Client
+s3 = FakeS3Client()
+clients.boto3.client = lambda *_, **__: s3
+run.get_external_ip = lambda: "127.0.0.1"
+with FakeS3() as fake:
+    startup_benchmark.prepare({handler!r}, s3, fake.url)
+    handler = getattr(handlers, {handler!r})
+    timings = []
+    for _ in range(2):
+        invoked = time.perf_counter()
+        handler({{}}, None)
+        timings.append(time.perf_counter() - invoked)
+print(json.dumps({{
+    "import_seconds": imported - start,
+    "handler_import_seconds": handler_imported - imported,
+    "first_invocation_seconds": timings[0],
+    "warm_invocation_seconds": timings[1],
+    "modules": modules,
+}}))
+"""
+
+
+def prepare(handler: str, s3: Any, fake_url: str) -> None:
+    """Set up the environment and fake S3 contents handler needs to run."""
+    os.environ.update(CONFIG_BUCKET="config", OUTPUT_BUCKET="output")
+    if handler == "config_handler":
+        for i in range(30):
+            s3.put_object(Body="", Bucket=f"bucket-{i}", Key="key")
+    if handler == "run_handler":
+        probe_client.ProbeClient = functools.partial(  # type: ignore
+            probe_client.ProbeClient, endpoint_url=fake_url
+        )
+        for account in range(3):
+            buckets = [f"bucket-{account}-{i}" for i in range(10)]
+            config = {"s3_bucket_list": buckets, "s3_random_files": {}}
+            s3.put_object(Body=dumps(config), Bucket="config", Key=f"{account}.json")
+
+
+def cold_start(handler: str) -> Dict[str, float]:
+    code = COLD_START.format(handler=handler, modules=HANDLER_MODULES[handler])
+    result = subprocess.run(
+        [sys.executable, "-c", code],
+        check=True,
+        stdout=subprocess.PIPE,
+        env={**os.environ, "PYTHONPATH": os.pathsep.join(sys.path)},
+    )
+    return json.loads(result.stdout.decode().splitlines()[-1])
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--handlers", nargs="+", default=list(HANDLER_MODULES))
+    parser.add_argument("--repeats", type=int, default=5)
+    args = parser.parse_args(argv)
+
+    results = {}
+    for handler in args.handlers:
+        runs = [cold_start(handler) for _ in range(args.repeats)]
+        results[handler] = {
+            metric: statistics.median(r[metric] for r in runs) for metric in runs[0]
+        }
+    print(json.dumps(results, indent=2, sort_keys=True))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
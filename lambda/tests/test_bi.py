@@ -1,6 +1,58 @@
+import gzip
+import importlib
+import io
+import json
+import random
+import subprocess
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+
+import pytest
+
+import analysis
+import checkpoint
+import clients
+import config
+import engine
+import history
+import jsonl_output
+import probe_client
 import run
+from json_dumper import dumps
 import s3_bucket_inspector as s3bi
+import shard
 import slack
+import throttle
+from metrics import metrics
+from fake_s3 import FakeS3, FakeS3Client
+
+
+@pytest.fixture
+def fake_s3():
+    with FakeS3() as fake:
+        previous = probe_client.get_client()
+        probe_client.set_client(
+            probe_client.ProbeClient(backoff=0.001, endpoint_url=fake.url)
+        )
+        yield fake
+        probe_client.set_client(previous)
+
+
+@pytest.fixture
+def s3_client(monkeypatch):
+    client = FakeS3Client()
+    monkeypatch.setattr(clients.boto3, "client", lambda *_, **__: client)
+    clients.clear()
+    yield client
+    clients.clear()
+
+
+@pytest.fixture
+def no_external_ip(monkeypatch):
+    monkeypatch.setattr(run, "get_external_ip", lambda: "127.0.0.1")
 
 
 def test_output_parsing_nothing():
@@ -34,6 +86,54 @@ def test_output_parsing():
     ) == {("PubliclyListableBucketIssue", "my-other-bucket")}
 
 
+def test_whitelist_patterns(s3_client):
+    whitelist = run.parse_whitelist(
+        {
+            "PubliclyReadableFileIssue": ["exact", "public-assets-*", "*-[0-9]"],
+            "*": ["account:123456789012"],
+        }
+    )
+    assert ("PubliclyReadableFileIssue", "exact") in whitelist
+    assert ("PubliclyReadableFileIssue", "exactly") not in whitelist
+    assert ("PubliclyReadableFileIssue", "public-assets-eu") in whitelist
+    assert ("PubliclyReadableFileIssue", "public-assets") not in whitelist
+    assert ("PubliclyReadableFileIssue", "logs-7") in whitelist
+    assert ("PubliclyListableBucketIssue", "public-assets-eu") not in whitelist
+    issues = [
+        {"issue": "PubliclyListableBucketIssue", "resource": "theirs"},
+        {"issue": "PubliclyListableBucketIssue", "resource": "ours"},
+    ]
+    owners = {"theirs": ["1", "123456789012"], "ours": ["1"]}
+    assert run.set_of_issues(dict(issues=issues, owners=owners), whitelist) == {
+        ("PubliclyListableBucketIssue", "ours")
+    }
+
+    s3_client.put_object(Body='{"*": ["a"]}', Bucket="config", Key="whitelist.json")
+    first = run.get_whitelist("config")
+    assert run.get_whitelist("config") is first  # Unchanged, so not compiled again
+    s3_client.put_object(Body='{"*": ["b"]}', Bucket="config", Key="whitelist.json")
+    assert ("AnyIssue", "b") in run.get_whitelist("config")
+
+
+def test_issues_are_compact_records(monkeypatch):
+    issue = s3bi.PubliclyReadableFileIssue("my.bucket", "key")
+    assert not hasattr(issue, "__dict__")
+    with pytest.raises(AttributeError):
+        issue.key = "other"
+    same = s3bi.PubliclyReadableFileIssue("my.bucket", "other-key")
+    whitelist = run.parse_whitelist({"PubliclyReadableFileIssue": ["my.bucket"]})
+    assert len({issue, same}) == 1
+    assert issue.pair in whitelist
+    lookups = []
+    monkeypatch.setattr(
+        s3bi, "bucket_region", lambda name: lookups.append(name) or "eu-west-1"
+    )
+    assert "help" not in issue.to_json(include_help=False)
+    assert not lookups  # Help isn't rendered unless needed
+    assert issue.help == issue.to_json()["help"]
+    assert lookups == ["my.bucket"]  # Rendered once
+
+
 def test_build_message():
     message = slack.build_message(
         [
@@ -50,6 +150,59 @@ def test_build_message():
     }
 
 
+def test_slack_messages_are_chunked_and_paced(monkeypatch):
+    issues = {("PubliclyReadableFileIssue", f"bucket-{i:04}") for i in range(1000)}
+    issues.add(("PubliclyListableBucketIssue", "listable"))
+    messages = slack.build_messages(
+        [slack.IssueGroup("danger", "issues", issues)], "my_bucket", "my_key"
+    )
+    attachments = [a for message in messages for a in message["attachments"]]
+    assert all(len(a["text"]) <= slack.MAX_ATTACHMENT_CHARS for a in attachments)
+    assert attachments[0]["title"] == "issues: PubliclyListableBucketIssue"
+    assert attachments[1]["title"].startswith("issues: PubliclyReadableFileIssue (1/")
+    assert sum(len(a["text"].split("\n")) for a in attachments) == len(issues)
+    by_account = slack.split_group(
+        slack.IssueGroup("danger", "issues", {("Issue", "a"), ("Issue", "b")}),
+        {"a": ["111"], "b": ["111", "222"]},
+    )
+    assert [(group.title, len(group.issues)) for group in by_account] == [
+        ("issues: 111", 2),
+        ("issues: 222", 1),
+    ]
+
+    class Response:
+        def __init__(self, status_code):
+            self.status_code = status_code
+            self.headers = {"Retry-After": "0"}
+
+        def raise_for_status(self):
+            assert self.status_code == 200
+
+    decrypted, posted = [], []
+    statuses = iter([429, 200, 200])
+    monkeypatch.setattr(slack.time, "sleep", lambda _: None)
+
+    class Kms:
+        @staticmethod
+        def decrypt(CiphertextBlob):
+            decrypted.append(CiphertextBlob)
+            return {"Plaintext": b"https://hook"}
+
+    monkeypatch.setattr(slack.clients, "client", lambda service: Kms)
+    slack.decrypt.cache_clear()
+    monkeypatch.setattr(
+        slack._session,
+        "post",
+        lambda url, data, timeout: posted.append(url) or Response(next(statuses)),
+    )
+    monkeypatch.setenv("ENCRYPTED_HOOK_URL", "c2VjcmV0")
+    slack.send_all([{"text": "one"}])
+    slack.send_all([{"text": "two"}])
+    assert posted == ["https://hook"] * 3  # The first message was rate limited
+    assert decrypted == [b"secret"]  # Cached for the container's lifetime
+    slack.decrypt.cache_clear()
+
+
 def test_diff():
     previous_issues = [
         issue.to_json()
@@ -72,3 +225,885 @@ def test_diff():
         {("PubliclyListableBucketIssue", "listable")},  # New issue
         {("PubliclyDeletableBucketIssue", "another-deletable")},  # Fixed issue
     )
+
+
+class SleepyTest(s3bi.BucketTest):
+    """Fake test which finds an issue on every other bucket after a short nap."""
+
+    def __init__(self, s3_bucket_list):
+        super().__init__(s3_bucket_list)
+        self.lock = threading.Lock()
+        self.in_flight = 0
+        self.max_in_flight = 0
+
+    def check(self, bucket_name):
+        with self.lock:
+            self.in_flight += 1
+            self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        time.sleep(random.uniform(0, 0.01))
+        with self.lock:
+            self.in_flight -= 1
+        if int(bucket_name.split("-")[-1]) % 2:
+            return s3bi.PubliclyDeletableBucketIssue(bucket_name)
+        return None
+
+
+def test_engine_results_sort_into_order():
+    test = SleepyTest([f"bucket-{i}" for i in range(50)])
+    probes = [(i, engine.Probe(test, name)) for i, name in enumerate(test.buckets)]
+    results = sorted(engine.ProbeEngine(max_workers=8).run(probes))
+    assert [probe.bucket_name for _, probe, _ in results] == test.buckets
+    sequential = [issue.resource for issue in test.find_issues()]
+    assert [issue.resource for _, _, issue in results if issue] == sequential
+
+
+def test_engine_yields_results_as_probes_finish():
+    release = threading.Event()
+
+    class SlowFirstTest(s3bi.BucketTest):
+        def check(self, bucket_name):
+            if bucket_name == "slow":
+                release.wait(timeout=10)
+
+    test = SlowFirstTest(["slow"] + [f"fast-{i}" for i in range(20)])
+    results = engine.ProbeEngine(max_workers=2).run(
+        (i, engine.Probe(test, name)) for i, name in enumerate(test.buckets)
+    )
+    assert {next(results)[0] for _ in range(20)} == set(range(1, 21))
+    release.set()
+    assert next(results)[0] == 0
+
+
+def test_engine_runs_probes_by_priority():
+    started, release = threading.Event(), threading.Event()
+    checked = []
+
+    class RecordingTest(s3bi.BucketTest):
+        def check(self, bucket_name):
+            started.set()
+            release.wait()
+            checked.append(bucket_name)
+
+    test = RecordingTest(["first", "low", "high"])
+
+    def probes():
+        yield 0, engine.Probe(test, "first")
+        started.wait()  # The only worker is busy, so the rest wait their turn
+        yield 1, engine.Probe(test, "low")
+        yield 2, engine.Probe(test, "high")
+        release.set()
+
+    priorities = {"first": 0, "low": 2, "high": 1}
+    results = engine.ProbeEngine(max_workers=1).run(
+        probes(), lambda probe: priorities[probe.bucket_name]
+    )
+    assert [key for key, _, _ in results] == [0, 2, 1]
+    assert checked == ["first", "high", "low"]
+
+
+def test_probes_after_the_deadline_are_reported(fake_s3, no_external_ip):
+    config = {"s3_bucket_list": ["open", "fixed"], "s3_random_files": {}}
+    previous = run.TestRunner("output", config).run()
+    issue = s3bi.PubliclyListableBucketIssue("fixed")
+    previous["issues"] = [{"test": "PubliclyListableBuckets", **issue.to_json()}]
+    previous_run = run.PreviousRun(previous, None)
+    assert previous_run.priority("fixed", None) < previous_run.priority("open", None)
+
+    late = run.TestRunner("output", config, deadline=time.monotonic() - 1)
+    requests = fake_s3.requests
+    output = late.run(previous)
+    assert fake_s3.requests == requests  # Nothing was probed
+    assert {entry["reason"] for entry in output["skipped"]} == {"deadline"}
+    assert len(output["skipped"]) == 3 * 2  # All but the readable files test
+    assert output["buckets"] == {}
+    assert output["issues"] == previous["issues"]  # Carried forward, unverified
+    assert run.diff_previous(output, previous) == (set(), set())  # Not fixed
+
+
+def test_engine_limits_per_endpoint():
+    test = SleepyTest(["same-bucket-1"] * 20)
+    probes = [(None, engine.Probe(test, bucket_name)) for bucket_name in test.buckets]
+    list(engine.ProbeEngine(max_workers=8, max_per_endpoint=2).run(probes))
+    assert test.max_in_flight <= 2
+
+    class SleepyFilesTest(SleepyTest):
+        requests_at_once = 4
+
+        def check_with(self, bucket_name, submit, at_once):
+            futures = [submit(self.check, bucket_name) for _ in range(at_once)]
+            return [future.result() for future in futures][0]
+
+    for buckets, limit in ((["same-bucket-1"] * 20, 2), (test.buckets[:20], 3)):
+        files_test = SleepyFilesTest(buckets)
+        probes = [(None, engine.Probe(files_test, name)) for name in buckets]
+        list(engine.ProbeEngine(max_workers=3, max_per_endpoint=2).run(probes))
+        assert 1 < files_test.max_in_flight <= limit  # Each request counts
+
+
+def test_probes_against_fake_s3(fake_s3):
+    fake_s3.listable.add("listable")
+    fake_s3.uploadable.add("uploadable")
+    fake_s3.deletable.add("deletable")
+    fake_s3.readable.add("readable/b")
+    assert s3bi.bucket_publicly_listable("listable")
+    assert not s3bi.bucket_publicly_listable("private")
+    assert s3bi.bucket_write_access("uploadable") == (True, False)
+    assert s3bi.bucket_write_access("deletable") == (False, True)
+    assert s3bi.bucket_write_access("private") == (False, False)
+    assert s3bi.file_publicly_readable("readable", "b")
+    assert not s3bi.file_publicly_readable("readable", "a")
+    assert fake_s3.connections == 1  # Every probe reused the same connection
+
+
+def test_write_tests_share_one_write_probe(fake_s3, no_external_ip):
+    fake_s3.uploadable.update({"open", "upload-only"})
+    fake_s3.deletable.add("open")
+    config = {
+        "s3_bucket_list": ["open", "upload-only", "locked"],
+        "s3_random_files": {},
+    }
+    output = run.TestRunner("output", config).run()
+    assert [(issue["test"], issue["resource"]) for issue in output["issues"]] == [
+        ("PubliclyUploadableBuckets", "open"),
+        ("PubliclyUploadableBuckets", "upload-only"),
+        ("PubliclyDeletableBuckets", "open"),
+    ]
+    assert fake_s3.requests == 3 + 3 * 2  # Listing, then a PUT and DELETE per bucket
+
+
+def test_write_probe_failures_reach_both_tests(monkeypatch):
+    def broken(bucket_name):
+        time.sleep(0.1)
+        raise RuntimeError(bucket_name)
+
+    monkeypatch.setattr(s3bi, "bucket_write_access", broken)
+    probes = s3bi.WriteProbes()
+    with ThreadPoolExecutor(2) as pool:
+        futures = [pool.submit(probes.get, "bucket") for _ in range(2)]
+        for future in futures:
+            with pytest.raises(RuntimeError):
+                future.result(timeout=5)
+
+
+ALL_USERS = {"URI": "http://acs.amazonaws.com/groups/global/AllUsers"}
+
+
+def bucket_access(grants=(), policy=None, public_access_block=None, ownership=None):
+    return {
+        "public_grants": list(grants),
+        "policy": policy and json.dumps(policy),
+        "public_access_block": public_access_block or {},
+        "object_ownership": ownership,
+    }
+
+
+def test_classify_access():
+    def classify(access, test):
+        return analysis.classify(access, test.action, test.acl_permissions)
+
+    listable, readable = s3bi.PubliclyListableBuckets, s3bi.PubliclyReadableFiles
+    uploadable = s3bi.PubliclyUploadableBuckets
+    public_put = {
+        "Statement": [
+            {"Effect": "Allow", "Principal": {"AWS": "*"}, "Action": "s3:Put*"}
+        ]
+    }
+    from_office = {
+        "Statement": {
+            "Effect": "Allow",
+            "Principal": "*",
+            "Action": ["s3:GetObject", "s3:ListBucket"],
+            "Condition": {"IpAddress": {"aws:SourceIp": "192.0.2.0/24"}},
+        }
+    }
+    private = bucket_access()
+    assert classify(None, listable) == "unknown"  # Old config
+    assert classify(private, listable) == "impossible"
+    assert classify(private, uploadable) == "impossible"
+    assert classify(private, readable) == "unknown"  # Object ACLs might be public
+    assert classify(bucket_access(ownership="BucketOwnerEnforced"), readable) == (
+        "impossible"
+    )
+    write_grant = {"Grantee": ALL_USERS, "Permission": "WRITE"}
+    assert classify(bucket_access([write_grant]), uploadable) == "possible"
+    assert classify(bucket_access([write_grant]), listable) == "impossible"
+    assert classify(bucket_access(policy=public_put), uploadable) == "possible"
+    assert classify(bucket_access(policy=from_office), listable) == "unknown"
+    assert classify(bucket_access(policy=from_office), uploadable) == "impossible"
+    assert classify(bucket_access(policy={"Statement": "?"}), listable) == "unknown"
+    blocked = bucket_access(
+        [write_grant],
+        public_put,
+        {"IgnorePublicAcls": True, "RestrictPublicBuckets": True},
+    )
+    for test in run.TestRunner.test_classes:
+        assert classify(blocked, test) == "impossible"
+
+
+def test_impossible_probes_are_pruned(fake_s3, no_external_ip):
+    fake_s3.listable.update({"blocked", "open"})
+    block = {"IgnorePublicAcls": True, "RestrictPublicBuckets": True}
+    config = {
+        "s3_bucket_list": ["blocked", "open"],
+        "s3_random_files": {"blocked": ["key"], "open": ["key"]},
+        "s3_bucket_access": {
+            "blocked": bucket_access(public_access_block=block),
+            "open": bucket_access([{"Grantee": ALL_USERS, "Permission": "READ"}]),
+        },
+    }
+    output = run.TestRunner("output", config).run()
+    assert [issue["resource"] for issue in output["issues"]] == ["open"]
+    assert fake_s3.requests == 2  # Listing and reading "open"; it can't be written
+    assert output["metrics"]["counters"]["probes.pruned"] == 6
+    audit = run.TestRunner("output", config, verify_all=True).run()
+    assert [issue["resource"] for issue in audit["issues"]] == ["blocked", "open"]
+    assert fake_s3.requests == 2 + 8
+
+
+def test_whitelisted_probes_are_skipped(fake_s3, no_external_ip):
+    fake_s3.listable.update({"public-assets", "private"})
+    config = {
+        "s3_bucket_list": ["public-assets", "private"],
+        "s3_random_files": {"public-assets": ["index.html"]},
+    }
+    whitelist = run.parse_whitelist({"*": ["public-*"]})
+    output = run.TestRunner("output", config, whitelist=whitelist).run()
+    assert [issue["resource"] for issue in output["issues"]] == ["private"]
+    assert fake_s3.requests == 3  # Listing, uploading and deleting only "private"
+    assert [entry["test"] for entry in output["skipped"]] == [
+        test.__name__ for test in run.TestRunner.test_classes
+    ]
+    assert {entry["reason"] for entry in output["skipped"]} == {"whitelisted"}
+    assert list(output["buckets"]) == ["private"]  # Nothing verified "public-assets"
+    assert run.unverified_issues(output) == {
+        (test.issue_class.__name__, "public-assets")
+        for test in run.TestRunner.test_classes
+    }
+
+    verified = run.TestRunner("output", config, whitelist=whitelist, verify_all=True)
+    output = verified.run()
+    assert {issue["resource"] for issue in output["issues"]} == {
+        "public-assets",
+        "private",
+    }
+    assert output["skipped"] == [] and output["verify_all"]
+    previous = output
+    fake_s3.listable.remove("public-assets")
+    only_files = run.parse_whitelist({"PubliclyReadableFileIssue": ["public-*"]})
+    fixed = run.TestRunner("output", config, whitelist=only_files).run()
+    assert run.diff_previous(fixed, previous, only_files) == (
+        set(),
+        {("PubliclyListableBucketIssue", "public-assets")},  # Fixed, still verified
+    )
+
+
+def test_skipped_probes_are_not_carried_forward(fake_s3, no_external_ip):
+    fake_s3.listable.add("public-assets")
+    config = {
+        "s3_bucket_list": ["public-assets"],
+        "s3_random_files": {},
+        "s3_bucket_fingerprints": {"public-assets": "a"},
+    }
+    whitelist = run.parse_whitelist({"PubliclyListableBucketIssue": ["public-*"]})
+    incremental = {"max_age": timedelta(days=1)}
+    previous = run.TestRunner(
+        "output", config, whitelist=whitelist, **incremental
+    ).run()
+    assert (
+        "PubliclyListableBuckets" not in previous["buckets"]["public-assets"]["tests"]
+    )
+    assert fake_s3.requests == 2  # Uploading and deleting
+    unlisted = run.TestRunner("output", config, **incremental).run(previous)
+    assert [issue["resource"] for issue in unlisted["issues"]] == ["public-assets"]
+    assert fake_s3.requests == 2 + 1  # Only listing; the rest was carried forward
+    audit = run.TestRunner(
+        "output", config, whitelist=whitelist, verify_all=True, **incremental
+    ).run(previous)
+    assert [issue["resource"] for issue in audit["issues"]] == ["public-assets"]
+    assert fake_s3.requests == 2 + 1 + 3  # Nothing carried forward
+
+
+def test_first_readable_key(fake_s3):
+    keys = [f"key-{i}" for i in range(20)]
+    fake_s3.readable.update({"bucket/key-5", "bucket/key-6", "bucket/key-15"})
+    with ThreadPoolExecutor(max_workers=4) as executor:
+        assert s3bi.first_readable_key("bucket", keys, 4, executor.submit) == "key-5"
+        assert fake_s3.requests < len(keys)  # Later keys weren't probed
+        assert s3bi.first_readable_key("bucket", keys[7:15], 4, executor.submit) is None
+    issue = s3bi.PubliclyReadableFiles({"bucket": keys[:1] + keys[6:]}).check("bucket")
+    assert issue.key == "key-6"
+
+
+def test_probe_client_retries_slow_down(fake_s3):
+    fake_s3.listable.add("busy")
+    fake_s3.slow_downs["busy"] = 2
+    assert s3bi.bucket_publicly_listable("busy")
+    assert fake_s3.requests == 3
+
+
+def test_throttled_probes_are_inconclusive(fake_s3, no_external_ip):
+    fake_s3.listable.update({"listable", "overloaded"})
+    fake_s3.slow_downs["overloaded"] = 100
+    config = {
+        "s3_bucket_list": ["listable", "overloaded"],
+        "s3_random_files": {"overloaded": ["key"]},
+    }
+    output = run.TestRunner("output", config).run()
+    assert [issue["resource"] for issue in output["issues"]] == ["listable"]
+    assert [entry["test"] for entry in output["inconclusive"]] == [
+        "PubliclyListableBuckets",
+        "PubliclyReadableFiles",
+        "PubliclyUploadableBuckets",
+        "PubliclyDeletableBuckets",
+    ]
+    assert "overloaded" not in output["buckets"]  # Probed again next time
+    issue = s3bi.PubliclyListableBucketIssue("overloaded")
+    previous = {"issues": [{"test": "PubliclyListableBuckets", **issue.to_json()}]}
+    assert run.diff_previous(output, previous) == (
+        {("PubliclyListableBucketIssue", "listable")},
+        set(),  # Can't tell whether "overloaded" was fixed
+    )
+    output = run.TestRunner("output", config).run(previous)
+    assert [issue["resource"] for issue in output["issues"]] == [
+        "listable",
+        "overloaded",  # Still open as far as we know, so not new next time
+    ]
+
+
+def test_rate_limiter_backs_off_and_recovers():
+    limiter = throttle.AdaptiveRateLimiter(max_rate=100)
+    limiter.on_throttle()
+    limiter.on_throttle()  # Same burst of 503s
+    assert limiter.rate == 50
+    limiter.on_success()
+    assert limiter.rate == 51
+    for _ in range(100):
+        limiter.on_success()
+    assert limiter.rate == 100
+
+
+def test_circuit_breaker():
+    breaker = throttle.CircuitBreaker(failure_threshold=2, cooldown=0.05)
+    assert not breaker.record_failure()
+    assert breaker.record_failure()
+    assert not breaker.allow()
+    time.sleep(0.05)
+    assert breaker.allow()  # One trial request
+    assert not breaker.allow()
+    breaker.record_success()
+    assert breaker.allow()
+
+
+class FakeLocationClient:
+    def __init__(self, locations):
+        self.locations = locations
+
+    def list_buckets(self):
+        return {"Buckets": [{"Name": name} for name in self.locations]}
+
+    def get_bucket_location(self, Bucket):
+        return {"LocationConstraint": self.locations[Bucket]}
+
+
+def test_bucket_regions_from_config():
+    regions = s3bi.get_s3_bucket_regions(
+        FakeLocationClient(
+            {
+                "no-dots": "eu-west-2",
+                "old.eu": "EU",
+                "us.east": None,
+                "a.b": "ap-east-1",
+            }
+        )
+    )
+    assert {name: entry["region"] for name, entry in regions.items()} == {
+        "old.eu": "eu-west-1",
+        "us.east": "us-east-1",
+        "a.b": "ap-east-1",
+    }
+    config = json.loads(dumps({"s3_bucket_regions": regions}))
+    config["s3_bucket_regions"]["a.b"]["resolved_time"] = (
+        datetime.utcnow() - timedelta(days=2)
+    ).isoformat()
+    s3bi.seed_bucket_regions(config["s3_bucket_regions"], timedelta(days=1))
+    assert s3bi.bucket_root("old.eu") == "https://s3-eu-west-1.amazonaws.com/old.eu"
+    assert "a.b" not in s3bi._bucket_regions  # Stale, so looked up again if needed
+
+
+class FakeListingClient:
+    def __init__(self, keys_by_bucket):
+        self.keys_by_bucket = keys_by_bucket
+        self.pages_fetched = 0
+
+    def list_buckets(self):
+        return {"Buckets": [{"Name": name} for name in self.keys_by_bucket]}
+
+    def get_paginator(self, _):
+        return self
+
+    def paginate(self, Bucket, PaginationConfig):
+        keys = self.keys_by_bucket[Bucket]
+        size = PaginationConfig["PageSize"]
+        for start in range(0, max(len(keys), 1), size):
+            self.pages_fetched += 1
+            yield {"Contents": [{"Key": key} for key in keys[start : start + size]]}
+
+
+def test_random_files_sample_beyond_first_page():
+    client = FakeListingClient(
+        {"big": [f"{i:05}" for i in range(1000)], "small": ["a", "b"], "empty": []}
+    )
+    files = s3bi.get_s3_random_files(
+        client, keys_to_return=10, keys_to_request=100, pages_to_request=None
+    )
+    assert set(files) == {"big", "small"}
+    assert sorted(files["small"]) == ["a", "b"]
+    assert len(set(files["big"])) == 10
+    assert max(files["big"]) >= "00100"  # Vanishingly unlikely to miss every later page
+
+
+def test_random_files_bounded_pages():
+    client = FakeListingClient({"big": [f"{i:05}" for i in range(1000)]})
+    files = s3bi.get_s3_random_files(
+        client, keys_to_return=10, keys_to_request=100, pages_to_request=2
+    )
+    assert all(key < "00200" for key in files["big"])
+    assert client.pages_fetched == 2
+
+
+def test_incremental_run_carries_forward_unchanged_buckets(fake_s3, no_external_ip):
+    fake_s3.listable.update({"listable", "changed"})
+    fake_s3.readable.add("readable/key")
+    config = {
+        "s3_bucket_list": ["listable", "readable", "changed"],
+        "s3_random_files": {"readable": ["key"]},
+        "s3_bucket_fingerprints": {"listable": "a", "readable": "b", "changed": "c"},
+    }
+    first = run.TestRunner("output", config, max_age=timedelta(days=1)).run()
+    assert fake_s3.requests == 10
+    previous = json.loads(dumps(first))
+    config["s3_bucket_fingerprints"]["changed"] = "d"
+    second = run.TestRunner("output", config, max_age=timedelta(days=1)).run(previous)
+    assert fake_s3.requests == 13  # Only "changed" probed again
+    assert second["issues"] == previous["issues"]
+    assert second["buckets"]["listable"]["verified_time"] == first["start_time"]
+    assert second["buckets"]["changed"]["verified_time"] == second["start_time"]
+
+
+def test_probe_metrics(fake_s3):
+    metrics.reset()
+    fake_s3.listable.add("busy")
+    fake_s3.slow_downs["busy"] = 1
+    s3bi.bucket_publicly_listable("busy")
+    s3bi.bucket_publicly_listable("private")
+    snapshot = metrics.snapshot()
+    assert snapshot["counters"] == {
+        "bucket_publicly_listable.calls": 2,
+        "bucket_publicly_listable.status.200": 1,
+        "bucket_publicly_listable.status.403": 1,
+        "bucket_publicly_listable.retries": 1,
+    }
+    assert snapshot["histograms"]["bucket_publicly_listable.latency"]["count"] == 2
+    (line,) = metrics.emf_lines("S3BucketInspector")
+    emf = json.loads(line)
+    assert emf["bucket_publicly_listable.calls"] == 2
+    assert sum(emf["bucket_publicly_listable.latency"]["Counts"]) == 2
+
+
+def test_handlers_start_lazily():
+    imported = subprocess.run(
+        [
+            sys.executable,
+            "-c",
+            "import importlib, sys; importlib.import_module('lambda'); "
+            "import config; print(sorted({'boto3', 'requests', 'run'} & set(sys.modules)))",
+        ],
+        check=True,
+        stdout=subprocess.PIPE,
+    )
+    assert imported.stdout.decode().strip() == "['boto3']"  # Config job needs only it
+    handlers = importlib.import_module("lambda")
+    previous = probe_client.get_client()
+    handlers.configure_probing()
+    client = probe_client.get_client()
+    handlers.configure_probing()  # A warm invocation
+    assert probe_client.get_client() is client
+    probe_client.set_client(previous)
+
+
+def test_run_handler_emits_every_phase(
+    fake_s3, s3_client, no_external_ip, monkeypatch, capsys
+):
+    for name, value in [
+        ("CONFIG_BUCKET", "config"),
+        ("OUTPUT_BUCKET", "output"),
+        ("EMF_NAMESPACE", "S3BucketInspector"),
+    ]:
+        monkeypatch.setenv(name, value)
+    monkeypatch.setattr(probe_client, "set_client", lambda client: None)
+    config = {"s3_bucket_list": ["bucket"], "s3_random_files": {}}
+    s3_client.put_object(Body=json.dumps(config), Bucket="config", Key="1.json")
+    importlib.import_module("lambda").run_handler({}, None)
+    emf = json.loads(capsys.readouterr().out.splitlines()[-1])
+    assert {name for name in emf if name.startswith("phase.")} == {
+        f"phase.{phase}"
+        for phase in [
+            "whitelist_fetch",
+            "config_fetch",
+            "previous_output_fetch",
+            "probing",
+            "upload",
+            "history",
+            "checkpoint",
+            "slack",
+        ]
+    }
+
+
+def test_sharded_run_matches_single_run(fake_s3, no_external_ip):
+    fake_s3.listable.update({"a-1", "b-2"})
+    fake_s3.deletable.update({"a-0", "b-1"})
+    fake_s3.readable.update({"a-2/key", "b-0/key"})
+    configs = {
+        f"{account}.json": {
+            "s3_bucket_list": [f"{account}-{i}" for i in range(3)],
+            "s3_random_files": {f"{account}-{i}": ["key"] for i in range(3)},
+        }
+        for account in ("a", "b")
+    }
+    single = run.TestRunner("output", *configs.values()).run()
+    sharded = shard.run_sharded(configs, shard.LocalExecutor("output"), shard_size=2)
+    assert len(shard.make_shards(configs, 2)) == 3
+    assert sharded["shards"] == 3
+    assert sharded["issues"] == single["issues"]
+    assert sharded["buckets"].keys() == single["buckets"].keys()
+
+
+def test_shared_buckets_probed_once(fake_s3, no_external_ip):
+    fake_s3.listable.add("shared")
+    fake_s3.readable.update({"shared/key-a", "shared/key-b"})
+    configs = {
+        "111.json": {
+            "s3_bucket_list": ["a", "shared"],
+            "s3_random_files": {"a": [], "shared": ["key-b"]},
+        },
+        "222.json": {
+            "s3_bucket_list": ["shared", "b"],
+            "s3_random_files": {"shared": ["key-a", "key-b"], "b": []},
+        },
+    }
+    metrics.reset()
+    output = run.TestRunner("output", config_stream=iter(configs.items())).run()
+    pairs = [(issue["issue"], issue["resource"]) for issue in output["issues"]]
+    assert len(pairs) == len(set(pairs))
+    assert ("PubliclyListableBucketIssue", "shared") in pairs
+    assert output["owners"]["shared"] == ["111", "222"]
+    counters = metrics.snapshot()["counters"]
+    assert counters["probes.deduplicated"] == len(run.TestRunner.test_classes) - 1
+
+    # Whichever config arrives first probes shared work, but results are
+    # placed by the lowest config key
+    reversed_stream = iter(reversed(list(configs.items())))
+    arrived_late = run.TestRunner("output", config_stream=reversed_stream).run()
+    assert [issue["resource"] for issue in arrived_late["issues"]] == [
+        issue["resource"] for issue in output["issues"]
+    ]
+    assert arrived_late["owners"] == output["owners"]
+    readable = [issue for issue in output["issues"] if "key" in issue]
+    assert [issue["key"] for issue in readable] == ["key-b"]
+    readable = [issue for issue in arrived_late["issues"] if "key" in issue]
+    assert [issue["key"] for issue in readable] == ["key-a"]  # 222.json probed it
+    body = io.BytesIO()
+    with jsonl_output.OutputWriter(body) as writer:
+        reversed_stream = iter(reversed(list(configs.items())))
+        streamed = run.TestRunner("output", config_stream=reversed_stream)
+        streamed.run(None, writer)
+    body.seek(0)
+    stored = jsonl_output.read_output(body)["issues"]
+    assert sorted(map(dumps, stored)) == sorted(
+        dumps({k: v for k, v in issue.items() if k != "help"})
+        for issue in arrived_late["issues"]
+    )
+
+    shards = shard.make_shards(configs, 1)
+    assert list(shards[1]) == ["111.json"]
+    assert shards[1]["111.json"]["s3_random_files"] == {"shared": ["key-b", "key-a"]}
+    assert configs["111.json"]["s3_random_files"]["shared"] == ["key-b"]
+    sharded = shard.run_sharded(configs, shard.LocalExecutor("output"), shard_size=1)
+    assert sharded["shards"] == 3
+    assert sharded["owners"]["shared"] == ["111", "222"]
+    assert sharded["issues"] == output["issues"]
+
+
+def test_only_top_level_json_files_are_outputs():
+    assert run.is_output_key("2020-01-01T00:00:00.json")
+    assert not run.is_output_key("partials/2020-01-01T00:00:00/0.json")
+
+
+def test_diff_previous_from_index(s3_client):
+    runner = run.TestRunner("output")
+    outputs = []
+    for resources in (["a", "b"], ["b", "c"]):
+        outputs.append(
+            {
+                "start_time": datetime.utcnow(),
+                "end_time": datetime.utcnow(),
+                "issues": [
+                    s3bi.PubliclyDeletableBucketIssue(resource).to_json()
+                    for resource in resources
+                ],
+            }
+        )
+        run.upload_output("output", outputs[-1])
+    s3_client.calls.clear()
+    expected = (
+        {("PubliclyDeletableBucketIssue", "c")},
+        {("PubliclyDeletableBucketIssue", "a")},
+    )
+    assert runner.diff_previous_s3(outputs[-1]) == expected
+    assert s3_client.calls == ["get_object", "get_object"]  # Pointer and index
+
+    del s3_client.objects["output"][run.LATEST_KEY]
+    s3_client.calls.clear()
+    assert runner.diff_previous_s3(outputs[-1]) == expected
+    assert "list_objects_v2" in s3_client.calls  # Fell back to listing outputs
+    assert history.open_since(
+        s3_client, "output", ("PubliclyDeletableBucketIssue", "b")
+    ) == run.parse_time(outputs[0]["start_time"])
+
+
+def test_history(s3_client):
+    a, b = ("Issue", "bucket-a"), ("Issue", "bucket-b")
+    day = datetime(2020, 1, 1, 10)
+    for run_time, issues, inconclusive in [
+        (day, {a, b}, set()),
+        (day + timedelta(hours=2), {a}, set()),
+        (day + timedelta(days=1), {a, b}, set()),
+        (day + timedelta(days=2), set(), {a}),  # Couldn't tell
+    ]:
+        history.update_history(s3_client, "output", run_time, issues, inconclusive)
+    assert sorted(s3_client.objects["output"]) == [
+        "history/2020-01-01.json.gz",
+        "history/2020-01-02.json.gz",
+        "history/2020-01-03.json.gz",
+        "history/latest.json",
+    ]
+    assert history.open_since(s3_client, "output", a) == day
+    assert history.open_since(s3_client, "output", b) is None
+    until = day + timedelta(days=3)
+    recent = history.issues_seen_since(
+        s3_client, "output", day + timedelta(days=1), until
+    )
+    assert recent == {
+        a: (day, day + timedelta(days=2)),  # Streak since the first run
+        b: (day + timedelta(days=1), day + timedelta(days=1)),
+    }
+    assert history.update_history(s3_client, "output", day, {a}, set()) is None
+
+
+def test_configs_streamed_into_runner(s3_client, fake_s3, no_external_ip):
+    s3_client.page_size = 2
+    fake_s3.listable.update({"bucket-1", "bucket-4"})
+    for account in range(5):
+        account_config = {
+            "s3_bucket_list": [f"bucket-{account}"],
+            "s3_random_files": {},
+        }
+        s3_client.put_object(
+            Body=dumps(account_config), Bucket="config", Key=f"{account}.json"
+        )
+    s3_client.put_object(Body="{}", Bucket="config", Key="whitelist.json")
+    configs = config.get_configs("config", workers=3)
+    assert list(configs) == [f"{account}.json" for account in range(5)]
+
+    stream = list(config.iter_configs("config", workers=3))
+    random.shuffle(stream)  # Arrival order isn't deterministic
+    runner = run.TestRunner("output", config_stream=iter(stream))
+    streamed = runner.run()
+    assert (
+        streamed["issues"]
+        == run.TestRunner("output", *configs.values()).run()["issues"]
+    )
+    assert streamed["accounts"] == ["0", "1", "2", "3", "4"]
+
+
+def test_interrupted_run_resumes_from_checkpoint(s3_client, fake_s3, no_external_ip):
+    fake_s3.listable.update({"bucket-1", "bucket-4"})
+    fake_s3.uploadable.add("bucket-2")
+    stream = [
+        (
+            f"{account}.json",
+            {"s3_bucket_list": [f"bucket-{account}"], "s3_random_files": {}},
+        )
+        for account in range(5)
+    ]
+    uninterrupted = run.TestRunner("output", config_stream=iter(stream)).run()
+
+    class Timeout(Exception):
+        pass
+
+    interrupted = run.TestRunner(
+        "output",
+        config_stream=iter(stream),
+        checkpoint=checkpoint.Checkpoint("output", interval=0),
+    )
+    probe = interrupted._engine.run
+
+    def time_out_after_5(probes, priority):
+        for done, result in enumerate(probe(probes, priority)):
+            if done == 5:
+                raise Timeout
+            yield result
+
+    interrupted._engine.run = time_out_after_5
+    with pytest.raises(Timeout):
+        interrupted.run_and_upload()
+    assert "checkpoints/latest.json.gz" in s3_client.objects["output"]
+
+    metrics.reset()
+    requests = fake_s3.requests
+    resumed = run.TestRunner(
+        "output",
+        config_stream=iter(stream),
+        checkpoint=checkpoint.Checkpoint("output", interval=0),
+    ).run_and_upload()
+    assert resumed["metrics"]["counters"]["probes.resumed"] == 5
+    assert fake_s3.requests - requests < requests / 2  # Only the rest was probed
+    for key in ("issues", "inconclusive", "skipped", "tests"):
+        assert resumed[key] == uninterrupted[key]
+    assert list(resumed["buckets"]) == list(uninterrupted["buckets"])
+    assert "checkpoints/latest.json.gz" not in s3_client.objects["output"]
+
+
+def test_index_keeps_every_priority_tier(s3_client, fake_s3, no_external_ip):
+    fake_s3.listable.add("open")
+    fingerprints = {"open": "a", "changed": "b", "unchanged": "c"}
+    config = {
+        "s3_bucket_list": list(fingerprints),
+        "s3_random_files": {},
+        "s3_bucket_fingerprints": fingerprints,
+    }
+    run.TestRunner("output", config).run_and_upload()
+    latest = json.load(
+        s3_client.get_object(Bucket="output", Key=run.LATEST_KEY)["Body"]
+    )
+    body = s3_client.get_object(Bucket="output", Key=latest["index_key"])["Body"]
+    index = json.loads(gzip.decompress(body.read()))
+    assert [issue["resource"] for issue in index["issues"]] == ["open"]
+    previous_run = run.PreviousRun(index, None)
+    fingerprints["changed"] = "d"
+    assert [
+        previous_run.priority(bucket_name, fingerprint)[0]
+        for bucket_name, fingerprint in fingerprints.items()
+    ] == [0, 1, 2]
+
+
+def test_run_past_deadline_keeps_checkpoint(s3_client, fake_s3, no_external_ip):
+    fake_s3.listable.add("bucket-1")
+    config = {"s3_bucket_list": ["bucket-0", "bucket-1"], "s3_random_files": {}}
+    run.TestRunner("output", config).run_and_upload()
+    s3_client.calls.clear()
+    late = run.TestRunner(
+        "output",
+        config,
+        checkpoint=checkpoint.Checkpoint("output", interval=3600),
+        deadline=time.monotonic() - 1,
+    )
+    output = late.run_and_upload()
+    assert "list_objects_v2" not in s3_client.calls  # Prioritised from the index
+    assert {entry["reason"] for entry in output["skipped"]} == {"deadline"}
+    assert "checkpoints/latest.json.gz" in s3_client.objects["output"]
+
+    resumed = run.TestRunner(
+        "output", config, checkpoint=checkpoint.Checkpoint("output")
+    ).run_and_upload()
+    assert resumed["skipped"] == [] and len(resumed["issues"]) == 1
+    assert resumed["start_time"] == output["start_time"]
+    assert "checkpoints/latest.json.gz" not in s3_client.objects["output"]
+
+
+def test_generate_lists_buckets_once(s3_client, monkeypatch):
+    regions = []
+
+    def regional_client(service, region_name=None, **_):
+        if service == "s3":
+            regions.append(region_name)
+        return s3_client
+
+    monkeypatch.setattr(clients.boto3, "client", regional_client)
+    for bucket_name, location in [("a", None), ("b.eu", "EU"), ("c", "ap-east-1")]:
+        s3_client.put_object(Body="x", Bucket=bucket_name, Key="key")
+        s3_client.locations[bucket_name] = location
+    output = config.generate(listing_workers=3)
+    assert output["s3_bucket_list"] == ["a", "b.eu", "c"]
+    assert output["s3_bucket_regions"]["b.eu"]["region"] == "eu-west-1"
+    assert output["s3_random_files"] == {name: ["key"] for name in ["a", "b.eu", "c"]}
+    assert len(output["s3_bucket_fingerprints"]) == 3
+    assert output["s3_bucket_access"]["a"] == {
+        "public_access_block": {},
+        "object_ownership": "ObjectWriter",
+        "public_grants": [],
+        "policy": None,
+    }
+    assert s3_client.calls.count("list_buckets") == 1
+    assert s3_client.calls.count("get_bucket_location") == 3
+    assert sorted(regions, key=str) == [None, "ap-east-1", "eu-west-1", "us-east-1"]
+
+
+def test_jsonl_output(s3_client, fake_s3, no_external_ip):
+    fake_s3.listable.add("listable")
+    fake_s3.readable.add("readable/key")
+    fake_s3.slow_downs["overloaded"] = 100
+    config = {
+        "s3_bucket_list": ["listable", "readable", "overloaded"],
+        "s3_random_files": {"readable": ["key"]},
+    }
+    output = run.TestRunner("output", config, output_format="jsonl").run_and_upload()
+    (key,) = [key for key in s3_client.objects["output"] if run.is_output_key(key)]
+    assert key == run.key_from_output(output)
+    assert key.endswith(".jsonl.gz")
+    body = s3_client.get_object(Bucket="output", Key=key)["Body"]
+    records = list(jsonl_output.read_records(body))
+    kinds = [record["record"] for record in records]
+    assert kinds[0] == "run" and kinds[-3:] == ["bucket", "bucket", "summary"]
+    assert sorted(kinds[1:-3]) == ["inconclusive"] * 3 + ["issue"] * 2  # As found
+    assert all("help" not in record for record in records)
+
+    stored = jsonl_output.read_output(
+        s3_client.get_object(Bucket="output", Key=key)["Body"]
+    )
+    for kind in ("issues", "inconclusive"):  # Stored as probes finished
+        assert sorted(map(dumps, stored[kind])) == sorted(map(dumps, output[kind]))
+    assert set(stored["buckets"]) == {"listable", "readable"}
+    assert run.set_of_issues(stored, None) == run.set_of_issues(output, None)
+    (readable,) = [
+        issue for issue in stored["issues"] if issue["resource"] == "readable"
+    ]
+    assert s3bi.issue_help(readable) == (
+        "The files stored within this S3 bucket should not be public, "
+        f"but {fake_s3.url}/readable/key was readable."
+    )
+
+    del s3_client.objects["output"][run.LATEST_KEY]  # Diffs stream the issues
+    fixed = {**output, "end_time": datetime.utcnow(), "issues": []}
+    new, resolved = run.TestRunner("output").diff_previous_s3(fixed)
+    assert not new and resolved == run.set_of_issues(output, None)
+
+    merged = json.loads(dumps(run.TestRunner("output", config).run()))
+    merged["format"] = "jsonl"
+    body = io.BytesIO()
+    jsonl_output.write_output(body, merged)
+    body.seek(0)
+    assert jsonl_output.read_output(body)["issues"] == output["issues"]
+
+
+def test_fingerprints_cover_the_account_block(s3_client):
+    settings = {"bucket": {"public_access_block": {}, "policy": None}}
+    fingerprints = [
+        s3bi.get_s3_bucket_fingerprints(
+            s3_client, bucket_settings=settings, account_block=block
+        )
+        for block in [None, {"BlockPublicPolicy": True}, None]
+    ]
+    assert fingerprints[0] != fingerprints[1]
+    assert fingerprints[0] == fingerprints[2]
@@ -0,0 +1,116 @@
+import threading
+import time
+from typing import Dict, Optional, Tuple
+
+
+class AdaptiveRateLimiter:
+    """Token bucket whose rate adapts to throttling (AIMD).
+
+    The rate starts at max_rate and grows by `increase` requests a second on
+    every unthrottled response. A throttled response halves it, at most once
+    per `decrease_interval` so a burst of 503s from requests that were already
+    in flight doesn't collapse it to min_rate.
+    """
+
+    min_rate = 1.0
+    increase = 1.0
+    decrease_interval = 1.0
+
+    def __init__(self, max_rate: float = 500.0) -> None:
+        self.rate = max_rate
+        self._max_rate = max_rate
+        self._tokens = max_rate
+        self._updated = time.monotonic()
+        self._last_decrease = 0.0
+        self._lock = threading.Lock()
+
+    def acquire(self) -> None:
+        """Take a token, sleeping until it's due if the bucket is empty."""
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(
+                self.rate, self._tokens + (now - self._updated) * self.rate
+            )
+            self._updated = now
+            self._tokens -= 1  # May go negative: the debt is our place in the queue
+            delay = -self._tokens / self.rate
+        if delay > 0:
+            time.sleep(delay)
+
+    def on_success(self) -> None:
+        with self._lock:
+            self.rate = min(self._max_rate, self.rate + self.increase)
+
+    def on_throttle(self) -> None:
+        with self._lock:
+            now = time.monotonic()
+            if now - self._last_decrease >= self.decrease_interval:
+                self.rate = max(self.min_rate, self.rate / 2)
+                self._tokens = min(self._tokens, self.rate)
+                self._last_decrease = now
+
+
+class CircuitBreaker:
+    """Stops requests to an endpoint after failure_threshold failures in a row.
+
+    Once open, requests are refused for `cooldown` seconds. Then a single trial
+    request is let through: success closes the circuit and failure keeps it
+    open for another cooldown.
+    """
+
+    def __init__(self, failure_threshold: int = 5, cooldown: float = 30.0) -> None:
+        self._failure_threshold = failure_threshold
+        self._cooldown = cooldown
+        self._failures = 0
+        self._open_until: Optional[float] = None
+        self._lock = threading.Lock()
+
+    def allow(self) -> bool:
+        with self._lock:
+            if self._open_until is None:
+                return True
+            now = time.monotonic()
+            if now < self._open_until:
+                return False
+            self._open_until = now + self._cooldown  # Only this one trial
+            return True
+
+    def record_success(self) -> None:
+        with self._lock:
+            self._failures = 0
+            self._open_until = None
+
+    def record_failure(self) -> bool:
+        """Count a failure, returning whether it opened the circuit."""
+        with self._lock:
+            self._failures += 1
+            if self._failures < self._failure_threshold:
+                return False
+            opened = self._open_until is None
+            self._open_until = time.monotonic() + self._cooldown
+            return opened
+
+
+class Endpoints:
+    """A rate limiter and circuit breaker per endpoint, created on first use."""
+
+    def __init__(
+        self,
+        max_rate: float = 500.0,
+        failure_threshold: int = 5,
+        cooldown: float = 30.0,
+    ) -> None:
+        self._max_rate = max_rate
+        self._failure_threshold = failure_threshold
+        self._cooldown = cooldown
+        self._endpoints: Dict[str, Tuple[AdaptiveRateLimiter, CircuitBreaker]] = {}
+        self._lock = threading.Lock()
+
+    def get(self, host: str) -> Tuple[AdaptiveRateLimiter, CircuitBreaker]:
+        with self._lock:
+            if host not in self._endpoints:
+                self._endpoints[host] = (
+                    AdaptiveRateLimiter(self._max_rate),
+                    CircuitBreaker(self._failure_threshold, self._cooldown),
+                )
+            return self._endpoints[host]
@@ -0,0 +1,102 @@
+"""Whitelist of issues not to notify about, compiled once into an index.
+
+whitelist.json maps an issue type, or "*" for every type, to a list of
+patterns. A pattern is a bucket name, a prefix such as "public-assets-*",
+any other glob, or "account:<account id>" for all of an account's buckets.
+"""
+
+import re
+from fnmatch import translate
+from typing import Dict, Iterable, List, Mapping, Optional, Pattern, Set, Tuple
+
+ANY_ISSUE = "*"
+ACCOUNT_PREFIX = "account:"
+GLOB_CHARS = frozenset("*?[")
+Pair = Tuple[str, str]  # Issue, resource
+_END = ""  # Trie key marking the end of a prefix, as no name character is ""
+
+
+class _Patterns:
+    """The patterns for one issue type: exact names, a prefix trie and one regex
+    for the remaining globs, so a lookup costs the length of the name however
+    many patterns there are."""
+
+    def __init__(self, patterns: Iterable[str]) -> None:
+        self.exact: Set[str] = set()
+        self.accounts: Set[str] = set()
+        self.prefixes: Dict[str, dict] = {}
+        globs: List[str] = []
+        for pattern in patterns:
+            if pattern.startswith(ACCOUNT_PREFIX):
+                self.accounts.add(pattern[len(ACCOUNT_PREFIX) :])
+            elif not GLOB_CHARS & set(pattern):
+                self.exact.add(pattern)
+            elif pattern.endswith("*") and not GLOB_CHARS & set(pattern[:-1]):
+                node = self.prefixes
+                for char in pattern[:-1]:
+                    node = node.setdefault(char, {})
+                node[_END] = {}
+            else:
+                globs.append(pattern)
+        self.globs: Optional[Pattern[str]] = (
+            re.compile("|".join(f"(?:{translate(glob)})" for glob in globs))
+            if globs
+            else None
+        )
+
+    def _has_prefix_of(self, name: str) -> bool:
+        node = self.prefixes
+        for char in name:
+            if _END in node:
+                return True
+            if char not in node:
+                return False
+            node = node[char]
+        return _END in node
+
+    def match(self, name: str, accounts: Iterable[str]) -> bool:
+        return (
+            name in self.exact
+            or not self.accounts.isdisjoint(accounts)
+            or self._has_prefix_of(name)
+            or (self.globs is not None and self.globs.match(name) is not None)
+        )
+
+
+class Whitelist:
+    def __init__(self, whitelist_json: Mapping[str, List[str]]) -> None:
+        self.whitelist_json = whitelist_json
+        self._index = {
+            issue: _Patterns(patterns) for issue, patterns in whitelist_json.items()
+        }
+
+    def matches(self, issue: str, resource: str, accounts: Iterable[str] = ()) -> bool:
+        """Whether the issue is whitelisted, given the accounts owning resource."""
+        return any(
+            patterns.match(resource, accounts)
+            for patterns in (self._index.get(issue), self._index.get(ANY_ISSUE))
+            if patterns
+        )
+
+    def __contains__(self, pair: Pair) -> bool:
+        issue, resource = pair
+        return self.matches(issue, resource)
+
+    def filter(
+        self,
+        pairs: Iterable[Pair],
+        owners: Optional[Mapping[str, Iterable[str]]] = None,
+    ) -> Set[Pair]:
+        """The pairs which aren't whitelisted, given the accounts owning each bucket."""
+        owners = owners or {}
+        return {
+            (issue, resource)
+            for issue, resource in pairs
+            if not self.matches(issue, resource, owners.get(resource, ()))
+        }
+
+    def __bool__(self) -> bool:
+        return bool(self._index)
+
+    def __repr__(self) -> str:
+        return f"Whitelist({self.whitelist_json!r})"
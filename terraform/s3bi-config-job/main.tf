@@ -30,7 +30,13 @@ resource "aws_iam_policy" "s3bi_lambda_list_policy" {
         {
             "Effect": "Allow",
             "Action": [
-                "s3:List*"
+                "s3:List*",
+                "s3:GetBucketLocation",
+                "s3:GetBucketAcl",
+                "s3:GetBucketPolicy",
+                "s3:GetBucketPublicAccessBlock",
+                "s3:GetBucketOwnershipControls",
+                "s3:GetAccountPublicAccessBlock"
             ],
             "Resource": "*"
         }
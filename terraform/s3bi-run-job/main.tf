@@ -65,6 +65,11 @@ resource "aws_iam_policy" "s3bi_lambda_write_output_policy" {
                 "${var.output_bucket_arn}",
                 "${var.output_bucket_arn}/*"
             ]
+        },
+        {
+            "Effect": "Allow",
+            "Action": "s3:DeleteObject",
+            "Resource": "${var.output_bucket_arn}/checkpoints/*"
         }
     ]
 }
@@ -91,6 +96,26 @@ resource "aws_iam_policy" "s3bi_lambda_decrypt_config_policy" {
 EOF
 }
 
+resource "aws_iam_policy" "s3bi_lambda_invoke_workers_policy" {
+  name_prefix = "s3bi_lambda_invoke_workers_policy"
+  description = "Ability to invoke itself as a worker for sharded runs"
+
+  policy = <<EOF
+{
+    "Version": "2012-10-17",
+    "Statement": [
+        {
+            "Effect": "Allow",
+            "Action": [
+                "lambda:InvokeFunction"
+            ],
+            "Resource": "${aws_lambda_function.s3bi_run_lambda.arn}"
+        }
+    ]
+}
+EOF
+}
+
 resource "aws_iam_role_policy_attachment" "s3bi-read-config" {
   role       = aws_iam_role.s3bi_lambda_run_role.name
   policy_arn = aws_iam_policy.s3bi_lambda_read_config_policy.arn
@@ -106,6 +131,11 @@ resource "aws_iam_role_policy_attachment" "s3bi-decrypt-hook" {
   policy_arn = aws_iam_policy.s3bi_lambda_decrypt_config_policy.arn
 }
 
+resource "aws_iam_role_policy_attachment" "s3bi-invoke-workers" {
+  role       = aws_iam_role.s3bi_lambda_run_role.name
+  policy_arn = aws_iam_policy.s3bi_lambda_invoke_workers_policy.arn
+}
+
 resource "aws_iam_role_policy_attachment" "s3bi-cloudwatch-logs" {
   role       = aws_iam_role.s3bi_lambda_run_role.name
   policy_arn = "arn:aws:iam::aws:policy/service-role/AWSLambdaBasicExecutionRole"
@@ -126,6 +156,7 @@ resource "aws_lambda_function" "s3bi_run_lambda" {
       OUTPUT_BUCKET      = var.output_bucket_name
       ENCRYPTED_HOOK_URL = var.encrypted_slack_hook
       DIFF_ONLY          = var.diff_only
+      SHARD_SIZE         = var.shard_size
     }
   }
 
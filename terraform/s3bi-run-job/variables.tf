@@ -20,6 +20,11 @@ variable "diff_only" {
   default = ""
 }
 
+variable "shard_size" {
+  # Set to a number of buckets to fan the run out over workers in shards of that size
+  default = ""
+}
+
 variable "config_bucket_name" {
   type = string
 }